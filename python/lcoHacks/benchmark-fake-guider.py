@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# benchmark-fake-guider.py
+#
+# Licensed under a 3-clause BSD license.
+
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import ConfigParser
+import imp
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.basic import LineReceiver
+
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+fakeGuider = imp.load_source('fakeGuider',
+                             os.path.join(scriptDir, 'fake-guider.py'))
+
+# A reply from the actor: commander or command id, message id, flag and
+# keywords.
+replyRe = re.compile(r'^(\S+)\s+(\d+)\s+(\S)\s?(.*)$')
+
+
+def getRSS():
+    """Returns the resident memory of this process in kB, or ``None``."""
+
+    try:
+        with open('/proc/self/status') as unit:
+            for line in unit:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    return None
+
+
+def parseMix(mix):
+    """Parses ``command:weight`` pairs into commands and probabilities.
+
+    The pairs are separated by commas; a command without a weight has weight
+    one.
+
+    """
+
+    commands = []
+    weights = []
+    for item in mix.split(','):
+        if not item.strip():
+            continue
+        command, weight = item.rsplit(':', 1) if ':' in item else (item, 1)
+        commands.append(command.strip())
+        weights.append(float(weight))
+
+    weights = np.array(weights)
+
+    return commands, weights / weights.sum()
+
+
+def getLatencyStats(latencies):
+    """Returns the count, mean, percentiles and maximum of latencies, in ms."""
+
+    if len(latencies) == 0:
+        return {'n': 0}
+
+    latencies = 1e3 * np.array(latencies)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+
+    return {'n': len(latencies), 'mean': float(latencies.mean()),
+            'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+            'max': float(latencies.max())}
+
+
+class BenchmarkCommander(LineReceiver):
+    """A stand-in for the hub that commands the actor and times its replies."""
+
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        self.factory.connected(self)
+
+    def lineReceived(self, line):
+        self.factory.reply(line.decode('utf-8', 'replace'))
+
+
+class Benchmark(ClientFactory):
+    """Sends a mix of commands to an actor at a fixed rate and times them.
+
+    Once connected, the commands in ``commands`` are drawn with
+    ``probabilities`` and sent at ``rate`` per second for ``duration``
+    seconds; each command is timed from when it is sent to its final reply.
+    Broadcasts (message id 0) are counted, and the memory of the process is
+    sampled every second. If ``streamRate`` is set, the synthetic keyword
+    stream of the actor is run at that rate for the duration of the
+    benchmark.
+
+    """
+
+    protocol = BenchmarkCommander
+
+    def __init__(self, commands, probabilities, rate, duration,
+                 streamRate=None, tick=0.01, drainTime=5., seed=None):
+
+        self.commands = commands
+        self.probabilities = probabilities
+        self.rate = rate
+        self.duration = duration
+        self.streamRate = streamRate
+        self.drainTime = drainTime
+
+        self.rng = np.random.RandomState(seed)
+
+        self.commander = None
+        self.mid = 0
+        self.pending = {}
+        self.latencies = dict((command, []) for command in commands)
+        self.nSent = 0
+        self.nFailed = 0
+        self.nBroadcast = 0
+        self.memory = []
+
+        self.startTime = None
+        self.endTime = None
+        self._sendLoop = task.LoopingCall(self._sendDue)
+        self._sendTick = tick
+        self._memoryLoop = task.LoopingCall(self._sampleMemory)
+
+    def send(self, cmdStr, command=None):
+        """Sends a command and records when it was sent."""
+
+        self.mid += 1
+        self.pending[self.mid] = (command, time.time())
+        line = 'bench %d %s' % (self.mid, cmdStr)
+        self.commander.sendLine(line.encode('utf-8'))
+
+    def connected(self, commander):
+
+        self.commander = commander
+        if self.streamRate:
+            self.send('stream start msgRate=%g' % (self.streamRate))
+
+        self.startTime = time.time()
+        self._memoryLoop.start(1.)
+        self._sendLoop.start(self._sendTick)
+        reactor.callLater(self.duration, self.stopSending)
+
+    def clientConnectionFailed(self, connector, reason):
+        print('cannot connect to the actor: %s' % (reason.getErrorMessage()),
+              file=sys.stderr)
+        reactor.stop()
+
+    def _sendDue(self):
+        """Sends the commands due since the benchmark started."""
+
+        nDue = int((time.time() - self.startTime) * self.rate) - self.nSent
+        if nDue <= 0:
+            return
+
+        commands = self.rng.choice(self.commands, size=nDue,
+                                   p=self.probabilities)
+        for command in commands:
+            self.send(command, command=command)
+        self.nSent += nDue
+
+    def _sampleMemory(self):
+        self.memory.append((time.time() - self.startTime, getRSS()))
+
+    def reply(self, line):
+
+        match = replyRe.match(line)
+        if match is None:
+            return
+
+        mid = int(match.group(2))
+        flag = match.group(3)
+
+        if mid == 0:
+            self.nBroadcast += 1
+            return
+
+        if flag not in ':f' or mid not in self.pending:
+            return
+
+        command, sentTime = self.pending.pop(mid)
+        if command is None:
+            return
+
+        if flag == 'f':
+            self.nFailed += 1
+        else:
+            self.latencies[command].append(time.time() - sentTime)
+
+        if self.endTime is not None and self._isDrained():
+            self.finish()
+
+    def _isDrained(self):
+        return all(command is None
+                   for command, sentTime in self.pending.values())
+
+    def stopSending(self):
+        """Stops sending commands and waits for the pending replies."""
+
+        self._sendLoop.stop()
+        self.endTime = time.time()
+
+        if self.streamRate:
+            self.send('stream stop')
+
+        if self._isDrained():
+            self.finish()
+        else:
+            reactor.callLater(self.drainTime, self.finish)
+
+    def finish(self):
+
+        if self._memoryLoop.running:
+            self._sampleMemory()
+            self._memoryLoop.stop()
+            reactor.stop()
+
+    def getResults(self):
+        """Returns the results of the benchmark as a dictionary."""
+
+        now = time.time()
+        sendTime = (self.endTime or now) - (self.startTime or now)
+        allLatencies = sum(self.latencies.values(), [])
+        rss = [sample[1] for sample in self.memory if sample[1] is not None]
+
+        def perSecond(count):
+            return count / sendTime if sendTime > 0 else 0.
+
+        return {
+            'commands': {'sent': self.nSent,
+                         'completed': len(allLatencies),
+                         'failed': self.nFailed,
+                         'lost': self.nSent - len(allLatencies) - self.nFailed,
+                         'rate': perSecond(self.nSent)},
+            'latency': getLatencyStats(allLatencies),
+            'latencyPerCommand': dict(
+                (command, getLatencyStats(latencies))
+                for command, latencies in self.latencies.items()),
+            'broadcast': {'messages': self.nBroadcast,
+                          'rate': perSecond(self.nBroadcast)},
+            'memory': {'startKB': rss[0] if rss else None,
+                       'endKB': rss[-1] if rss else None,
+                       'maxKB': max(rss) if rss else None,
+                       'growthKB': rss[-1] - rss[0] if rss else None,
+                       'samples': self.memory}}
+
+
+defaultMix = 'ping:8,status:1,broadcast status:1'
+
+
+def runBenchmark(config, mix=defaultMix, rate=100., duration=10.,
+                 streamRate=None, name='guider', port=None, seed=None):
+    """Runs a fake actor and benchmarks it with a local commander.
+
+    The actor is created from ``config`` without a connection to the hub and
+    listens on ``port`` (by default, the one in the configuration) on the
+    loopback interface. Returns the results of the `Benchmark`, with the
+    actor's own performance statistics and the benchmark parameters.
+
+    """
+
+    if not config.has_section(name):
+        config.add_section(name)
+    config.set(name, 'interface', '127.0.0.1')
+    if port is not None:
+        config.set(name, 'port', str(port))
+    port = int(config.get(name, 'port') if config.has_option(name, 'port')
+               else config.get('tron', 'port'))
+
+    commands, probabilities = parseMix(mix)
+    benchmark = Benchmark(commands, probabilities, rate, duration,
+                          streamRate=streamRate, seed=seed)
+
+    actor = fakeGuider.FakeGuider(name, makeCmdrConnection=False,
+                                  config=config)
+    actor.run(doReactor=False)
+
+    reactor.connectTCP('127.0.0.1', port, benchmark)
+    reactor.run()
+    actor._shutdown()
+
+    results = benchmark.getResults()
+    results['actor'] = actor.perfStats.toDict()
+    results['parameters'] = {'mix': mix, 'rate': rate, 'duration': duration,
+                             'streamRate': streamRate, 'name': name,
+                             'port': port, 'time': time.time(),
+                             'python': sys.version.split()[0]}
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]))
+
+    parser.add_argument('--config', '-c', metavar='CONFIG', type=str,
+                        default=None,
+                        help='The actor configuration. Defaults to '
+                             'guider.cfg.')
+    parser.add_argument('--mix', '-m', type=str, default=defaultMix,
+                        help='The commands to send, as comma-separated '
+                             'command:weight pairs.')
+    parser.add_argument('--rate', '-r', type=float, default=100.,
+                        help='Commands per second.')
+    parser.add_argument('--duration', '-d', type=float, default=10.,
+                        help='Seconds during which to send commands.')
+    parser.add_argument('--stream-rate', '-s', dest='streamRate',
+                        type=float, default=None,
+                        help='Run the synthetic keyword stream at this many '
+                             'messages per second during the benchmark.')
+    parser.add_argument('--port', '-p', type=int, default=None,
+                        help='The port for the actor. Defaults to the '
+                             'configured one.')
+    parser.add_argument('--logdir', type=str, default=None,
+                        help='The log directory of the actor. Defaults to a '
+                             'temporary one.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='The seed for the command mix.')
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='A JSON file in which to write the results.')
+
+    args = parser.parse_args()
+
+    config = ConfigParser.ConfigParser()
+    config.read(args.config or os.path.join(scriptDir, 'guider.cfg'))
+    config.set('logging', 'logdir', args.logdir or tempfile.mkdtemp())
+
+    results = runBenchmark(config, mix=args.mix, rate=args.rate,
+                           duration=args.duration,
+                           streamRate=args.streamRate, port=args.port,
+                           seed=args.seed)
+
+    latency = results['latency']
+    print('{0} commands sent, {1} completed, {2} failed, {3} lost.'.format(
+        results['commands']['sent'], results['commands']['completed'],
+        results['commands']['failed'], results['commands']['lost']))
+    if latency['n'] > 0:
+        print('Latency (ms): p50={0:.3f} p90={1:.3f} p99={2:.3f} '
+              'max={3:.3f}'.format(latency['p50'], latency['p90'],
+                                   latency['p99'], latency['max']))
+    print('Broadcast: {0} messages, {1:.1f} messages/s.'.format(
+        results['broadcast']['messages'], results['broadcast']['rate']))
+    print('Memory growth: {0} kB.'.format(results['memory']['growthKB']))
+
+    if args.output:
+        with open(args.output, 'w') as unit:
+            json.dump(results, unit, indent=2, sort_keys=True)
@@ -18,12 +18,27 @@ import os
 from sdss.utilities import yanny
 import numpy as np
 import argparse
+import hashlib
+import json
+import multiprocessing
+import re
 import string
 
 
 cart = 21
 nGuides = 16
 
+# Pointings in a guider commissioning plate
+allPointings = 'ABCD'
+
+# Maximum size, in bytes, of the plPlugMapP cache directory
+cacheMaxSize = 512 * 1024**2
+
+# Default file recording the inputs of each plPlugMapM, and the version of its
+# fingerprints. Increasing the version makes all the outputs stale.
+manifestFile = 'plPlugMapM_manifest.json'
+manifestVersion = 1
+
 # Links field numbers to marking colours
 colourDict = {1: 'GREEN', 2: 'BLUE', 3: 'VIOLET'}
 
@@ -54,28 +69,109 @@ idlVersion 7.1
 """
 
 
-def addHeader(header, file, plateID, fscanID, field, mjd, fieldColour):
-    """Adds a header to a yanny file after the commented section."""
+def getHeader(header, plateID, fscanID, field, mjd, fieldColour):
+    """Returns the header lines of a plPlugMapM, including the fscan data."""
 
     fscanData = template.format(plateID=plateID, mjd=mjd, fscanID=fscanID,
                                 cart=cart, field=field,
                                 fieldColour=fieldColour)
 
-    header = [''] + header + fscanData.splitlines() + ['']
+    return [''] + header + fscanData.splitlines() + ['']
 
-    fileLines = open(file, 'r').read().splitlines()
 
-    for ii, line in enumerate(fileLines):
-        if not line.startswith('#'):
-            break
+def _protect(value):
+    """Formats a value for a yanny file, quoting it if necessary."""
+
+    if isinstance(value, bytes) and not isinstance(value, str):
+        value = value.decode()
+
+    value = str(value)
+
+    if len(value) == 0 or '#' in value or len(value.split()) != 1:
+        return '"' + value + '"'
+
+    return value
+
+
+def getTypedefs(dtype, enums, structname='PLUGMAPOBJ'):
+    """Returns the yanny typedef lines for a structured array dtype.
+
+    ``enums`` must have the same format as for
+    ``yanny.write_ndarray_to_yanny``.
+
+    """
+
+    typeMap = {'i2': 'short', 'i4': 'int', 'i8': 'long',
+               'f4': 'float', 'f8': 'double'}
+
+    lines = []
+
+    for column in sorted(enums):
+        enumName, values = enums[column]
+        lines.append('typedef enum {')
+        lines += ['    {0},'.format(value) for value in values]
+        lines[-1] = lines[-1].rstrip(',')
+        lines.append('}} {0};'.format(enumName.upper()))
+        lines.append('')
+
+    lines.append('typedef struct {')
+    for column in dtype.names:
+        colType, shape = dtype[column].base, dtype[column].shape
+        if column in enums:
+            line = '    {0} {1}'.format(enums[column][0].upper(), column)
+        elif colType.kind in 'SU':
+            line = '    char {0}'.format(column)
+        else:
+            line = '    {0} {1}'.format(typeMap[colType.str[1:]], column)
+        if len(shape) > 0:
+            line += '[{0:d}]'.format(shape[0])
+        if colType.kind in 'SU' and column not in enums:
+            size = colType.itemsize // (4 if colType.kind == 'U' else 1)
+            line += '[{0:d}]'.format(size)
+        lines.append(line + ';')
+    lines.append('}} {0};'.format(structname.upper()))
+
+    return lines
 
-    for line in header[::-1]:
-        fileLines.insert(ii, line)
 
-    unit = open(file, 'w')
-    for line in fileLines:
-        unit.write(line + '\n')
-    unit.close()
+def writePar(output, data, header, enums, structname='PLUGMAPOBJ'):
+    """Writes a structured array as a yanny file in a single pass.
+
+    The header lines, the enum and struct typedefs, and the rows of ``data``
+    are formatted in memory and written to ``output`` with a single call.
+    ``output`` can be a filename, an open file-like object (e.g., a
+    ``StringIO`` buffer), or ``'-'`` to write to stdout.
+
+    """
+
+    lines = ['#%yanny', '#', '# Created by create_plPlugMapM_LCO.py', '#']
+    lines += header
+    lines += getTypedefs(data.dtype, enums, structname=structname)
+    lines.append('')
+
+    columns = data.dtype.names
+    isArray = [len(data.dtype[column].shape) > 0 for column in columns]
+
+    for row in data:
+        values = [structname.upper()]
+        for column, array in zip(columns, isArray):
+            if array:
+                values.append(
+                    '{' + ' '.join(map(_protect, row[column])) + '}')
+            else:
+                values.append(_protect(row[column]))
+        lines.append(' '.join(values))
+
+    contents = '\n'.join(lines) + '\n'
+
+    if output == '-':
+        sys.stdout.write(contents)
+        sys.stdout.flush()
+    elif isinstance(output, str):
+        with open(output, 'w') as unit:
+            unit.write(contents)
+    else:
+        output.write(contents)
 
     return
 
@@ -89,31 +185,441 @@ def getLookupArray(lookupTable):
     if lookupTable is None:
         return np.array([np.arange(1, 17), np.arange(1, 17)]).T
 
-    return np.loadtxt(lookupTable).astype(np.int)
+    return np.loadtxt(lookupTable).astype(int)
 
 
-def create_plPlugMapM_LCO(plateID, pointing, field, mjd,
-                          lookupTable=None, fscanId=1):
-    """Converts the plPlugMapP files for a `plateID` into a plPlugMapM.
+def simulateLookupArrays(nSims, mode='random', nSwapped=0, nMissing=0,
+                         brokenFibres=None, seed=None):
+    """Simulates ``nSims`` mappings of the guide fibres to holes.
 
-    This scripts converts the plPlugMapP files for a `plateID` into a
-    plPlugMapM given a lookup table that simulates a mapping.
+    Returns two ``(nSims, nGuides)`` arrays, ``fibres`` and ``holes``, that
+    are the equivalent of the two columns of `getLookupArray` for each
+    simulation: the fibre ``fibres[n, ii]`` is plugged in the hole
+    ``holes[n, ii]`` (1-indexed, in the order of the plPlugMapP file).
 
-    Each guider commissioning plate contains four pointings, each with 3
-    sets of 16 guiding stars (fields).
+    Parameters:
+        nSims (int):
+            The number of mappings to simulate.
+        mode (str):
+            How fibres are assigned to holes. ``'identity'`` plugs fibre
+            ``ii`` in hole ``ii``, ``'shift'`` applies a random cyclic shift
+            to the identity mapping, and ``'random'`` uses a random
+            permutation.
+        nSwapped (int):
+            The number of pairs of fibres that are swapped after the mapping
+            has been created.
+        nMissing (int):
+            The number of fibres, different for each simulation, that are
+            not found by the mapper. Their fiberId is set to -1.
+        brokenFibres (list or None):
+            A list of fibres that are broken in all the simulations. Their
+            fiberId is set to -1.
+        seed (int or None):
+            The seed for the random number generator.
 
     """
 
-    lookupArray = getLookupArray(lookupTable)
+    assert 2 * nSwapped <= nGuides, 'too many swapped fibres'
+    assert nMissing <= nGuides, 'too many missing fibres'
+
+    rng = np.random.RandomState(seed)
+
+    identity = np.tile(np.arange(1, nGuides + 1), (nSims, 1))
+    rows = np.arange(nSims)[:, np.newaxis]
+
+    if mode == 'identity':
+        holes = identity.copy()
+    elif mode == 'shift':
+        shifts = rng.randint(0, nGuides, size=(nSims, 1))
+        holes = (identity - 1 + shifts) % nGuides + 1
+    elif mode == 'random':
+        holes = np.argsort(rng.random_sample((nSims, nGuides)), axis=1) + 1
+    else:
+        raise ValueError('invalid simulation mode {0!r}'.format(mode))
+
+    if nSwapped > 0:
+        # Chooses 2 * nSwapped different fibres per simulation and swaps
+        # the holes of each pair.
+        chosen = np.argsort(rng.random_sample((nSims, nGuides)), axis=1)
+        first = chosen[:, :nSwapped]
+        second = chosen[:, nSwapped:2 * nSwapped]
+        holes[rows, first], holes[rows, second] = (holes[rows, second],
+                                                   holes[rows, first])
+
+    fibres = identity.copy()
+
+    if nMissing > 0:
+        missing = np.argsort(rng.random_sample((nSims, nGuides)),
+                             axis=1)[:, :nMissing]
+        fibres[rows, missing] = -1
+
+    if brokenFibres is not None and len(brokenFibres) > 0:
+        fibres[:, np.array(brokenFibres, dtype=int) - 1] = -1
+
+    return fibres, holes
+
+
+def getPlPlugMapPPath(plateID, pointing):
+    """Returns the path to the plPlugMapP file for a plate and pointing."""
 
     pointingName = '' if pointing == 'A' else pointing
 
-    filename = os.path.join(
+    return os.path.join(
         os.environ['PLATELIST_DIR'], 'plates',
         '{0:06d}'.format(plateID)[:-2] + 'XX', '{0:06d}'.format(plateID),
         'plPlugMapP-{0:d}{1}.par'.format(plateID, pointingName))
 
-    assert os.path.exists(filename)
+
+class PlateIndex(object):
+    """An index of the plPlugMap files under ``PLATELIST_DIR/plates``.
+
+    Maps each plateID to its pointings and, for each pointing, to the paths
+    of its plPlugMapP and plPlugMapM files. The index can be saved to
+    ``indexFile`` as JSON. `.refresh` only lists the groups whose mtime has
+    changed since the last time they were scanned, and the plates asked for.
+
+    """
+
+    plPlugMapRe = re.compile(r'^plPlugMap([PM])-(\d+)([B-Z]?)[-.].*par$')
+
+    def __init__(self, indexFile=None, platelistDir=None):
+
+        self.indexFile = indexFile
+        self.platesDir = os.path.join(
+            platelistDir or os.environ['PLATELIST_DIR'], 'plates')
+
+        self.groups = {}
+        self.plates = {}
+
+        if self.indexFile is not None and os.path.exists(self.indexFile):
+            data = json.load(open(self.indexFile, 'r'))
+            if data['platesDir'] == self.platesDir:
+                self.groups = data['groups']
+                self.plates = data['plates']
+
+    def save(self):
+        """Saves the index to ``indexFile``."""
+
+        if self.indexFile is None:
+            return
+
+        tmpFile = self.indexFile + '.tmp{0:d}'.format(os.getpid())
+        with open(tmpFile, 'w') as unit:
+            json.dump({'platesDir': self.platesDir, 'groups': self.groups,
+                       'plates': self.plates}, unit)
+        os.rename(tmpFile, self.indexFile)
+
+    def refresh(self, plateIDs=None):
+        """Updates the index with the directories that have changed.
+
+        Groups whose mtime has not changed are trusted, since plate
+        directories are only added to or removed from a group by changing
+        it. Within those groups, only the directories of the plates in
+        ``plateIDs`` are checked for new or modified files.
+
+        """
+
+        requested = set()
+        if plateIDs is not None:
+            requested = set('{0:06d}'.format(int(plateID))
+                            for plateID in plateIDs)
+
+        groups = [group for group in os.listdir(self.platesDir)
+                  if group.endswith('XX')]
+
+        for group in list(self.groups):
+            if group not in groups:
+                self._removeGroup(group)
+
+        for group in groups:
+            groupDir = os.path.join(self.platesDir, group)
+            mtime = os.stat(groupDir).st_mtime
+
+            if self.groups.get(group) != mtime:
+                plateDirs = os.listdir(groupDir)
+                for plateDir in list(self.plates):
+                    if (self.plates[plateDir]['group'] == group and
+                            plateDir not in plateDirs):
+                        self.plates.pop(plateDir)
+                for plateDir in plateDirs:
+                    self._scanPlate(group, plateDir)
+                self.groups[group] = mtime
+            else:
+                for plateDir in requested:
+                    if plateDir[:-2] + 'XX' == group:
+                        self._scanPlate(group, plateDir)
+
+        return self
+
+    def _removeGroup(self, group):
+        """Removes all the plates in a group from the index."""
+
+        self.groups.pop(group, None)
+        for plateDir in list(self.plates):
+            if self.plates[plateDir]['group'] == group:
+                self.plates.pop(plateDir)
+
+    def _scanPlate(self, group, plateDir):
+        """Lists a plate directory, if it has changed since the last scan."""
+
+        path = os.path.join(self.platesDir, group, plateDir)
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.plates.pop(plateDir, None)
+            return
+
+        if plateDir in self.plates and self.plates[plateDir]['mtime'] == mtime:
+            return
+
+        pointings = {}
+        for filename in os.listdir(path):
+            match = self.plPlugMapRe.match(filename)
+            if not match:
+                continue
+            fileType, __, pointingName = match.groups()
+            pointing = pointings.setdefault(pointingName or 'A',
+                                            {'P': None, 'M': []})
+            if fileType == 'P':
+                pointing['P'] = os.path.join(path, filename)
+            else:
+                pointing['M'].append(os.path.join(path, filename))
+
+        self.plates[plateDir] = {'group': group, 'mtime': mtime,
+                                 'pointings': pointings}
+
+    def _getPlate(self, plateID):
+        """Returns the index entry for a plate."""
+
+        plateDir = '{0:06d}'.format(plateID)
+        if plateDir not in self.plates:
+            raise IOError('plate {0} not found in {1}'.format(
+                plateID, self.platesDir))
+
+        return self.plates[plateDir]
+
+    def getPointings(self, plateID):
+        """Returns the pointings for which a plate has a plPlugMapP file."""
+
+        pointings = self._getPlate(plateID)['pointings']
+
+        return sorted(pointing for pointing in pointings
+                      if pointings[pointing]['P'] is not None)
+
+    def getPlPlugMapP(self, plateID, pointing):
+        """Returns the path to the plPlugMapP file for a plate and pointing."""
+
+        pointings = self._getPlate(plateID)['pointings']
+
+        if pointing not in pointings or pointings[pointing]['P'] is None:
+            raise IOError('plate {0} does not have a plPlugMapP file for '
+                          'pointing {1}'.format(plateID, pointing))
+
+        return pointings[pointing]['P']
+
+    def getPlPlugMapMs(self, plateID, pointing):
+        """Returns the plPlugMapM files for a plate and pointing."""
+
+        pointings = self._getPlate(plateID)['pointings']
+
+        if pointing not in pointings:
+            return []
+
+        return sorted(pointings[pointing]['M'])
+
+
+def findPlPlugMapP(plateID, pointing, plateIndex=None):
+    """Returns the path to an existing plPlugMapP file.
+
+    Uses ``plateIndex``, if provided. Otherwise the path is built from
+    ``PLATELIST_DIR``. Raises an `IOError` if the file does not exist.
+
+    """
+
+    if plateIndex is not None:
+        return plateIndex.getPlPlugMapP(plateID, pointing)
+
+    filename = getPlPlugMapPPath(plateID, pointing)
+
+    if not os.path.exists(filename):
+        raise IOError('cannot find plPlugMapP file for plate {0}, '
+                      'pointing {1}: {2}'.format(plateID, pointing, filename))
+
+    return filename
+
+
+def _getCacheKey(filename):
+    """Returns the cache key for a file, based on its path, mtime and size."""
+
+    stat = os.stat(filename)
+    key = '{0}:{1!r}:{2:d}'.format(os.path.abspath(filename),
+                                   stat.st_mtime, stat.st_size)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _readCache(cacheDir, key):
+    """Loads a cached plPlugMapP. Returns ``None`` if it is not cached.
+
+    The PLUGMAPOBJ array is memory-mapped. The access time of the entry is
+    updated so that it is the last one to be evicted.
+
+    """
+
+    npyFile = os.path.join(cacheDir, key + '.npy')
+    metaFile = os.path.join(cacheDir, key + '.json')
+
+    if not os.path.exists(npyFile) or not os.path.exists(metaFile):
+        return None
+
+    try:
+        plPlugMapObj = np.load(npyFile, mmap_mode='r')
+        meta = json.load(open(metaFile, 'r'))
+    except (IOError, ValueError):
+        return None
+
+    for path in [npyFile, metaFile]:
+        os.utime(path, None)
+
+    return plPlugMapObj, meta['enums'], meta['header']
+
+
+def _writeCache(cacheDir, key, plPlugMapObj, enums, header,
+                maxSize=cacheMaxSize):
+    """Stores a parsed plPlugMapP in the cache and evicts old entries."""
+
+    if not os.path.exists(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            # Another process may have created it in the meantime.
+            pass
+
+    # Writes to temporary files and renames them so that processes
+    # reading the cache concurrently never see a partial entry.
+    tmpSuffix = '.tmp{0:d}'.format(os.getpid())
+
+    npyFile = os.path.join(cacheDir, key + '.npy')
+    with open(npyFile + tmpSuffix, 'wb') as unit:
+        np.save(unit, np.ascontiguousarray(plPlugMapObj))
+    os.rename(npyFile + tmpSuffix, npyFile)
+
+    metaFile = os.path.join(cacheDir, key + '.json')
+    with open(metaFile + tmpSuffix, 'w') as unit:
+        json.dump({'enums': enums, 'header': header}, unit)
+    os.rename(metaFile + tmpSuffix, metaFile)
+
+    _evictCache(cacheDir, maxSize)
+
+
+def _evictCache(cacheDir, maxSize):
+    """Removes the least recently used entries until under ``maxSize``."""
+
+    entries = {}
+    for name in os.listdir(cacheDir):
+        key, ext = os.path.splitext(name)
+        if ext not in ['.npy', '.json']:
+            continue
+        path = os.path.join(cacheDir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        lastUsed, size = entries.get(key, (0, 0))
+        entries[key] = (max(lastUsed, stat.st_mtime), size + stat.st_size)
+
+    totalSize = sum(size for __, size in entries.values())
+
+    for key in sorted(entries, key=lambda key: entries[key][0]):
+        if totalSize <= maxSize:
+            break
+        for ext in ['.npy', '.json']:
+            try:
+                os.remove(os.path.join(cacheDir, key + ext))
+            except OSError:
+                pass
+        totalSize -= entries[key][1]
+
+
+def _hashFile(filename, inputs):
+    """Returns the SHA1 of the contents of a file.
+
+    ``inputs`` maps paths to the mtime, size and hash of files already
+    hashed. The hash is reused if the file has not changed, and ``inputs``
+    is updated otherwise.
+
+    """
+
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+
+    entry = inputs.get(path)
+    if (entry is not None and entry['mtime'] == stat.st_mtime and
+            entry['size'] == stat.st_size):
+        return entry['sha1']
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as unit:
+        for chunk in iter(lambda: unit.read(1024**2), b''):
+            sha1.update(chunk)
+
+    inputs[path] = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                    'sha1': sha1.hexdigest()}
+
+    return inputs[path]['sha1']
+
+
+def _getFingerprint(plPlugMapPHash, lookupHash, plateID, pointing, field,
+                    mjd, fscanId, simulation=None):
+    """Returns the fingerprint of the inputs of a plPlugMapM."""
+
+    key = json.dumps([manifestVersion, plPlugMapPHash, lookupHash, plateID,
+                      pointing, field, mjd, fscanId, simulation],
+                     sort_keys=True)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def readManifest(filename):
+    """Reads a manifest of plPlugMapM fingerprints.
+
+    Returns a dictionary with the hashes of the ``inputs`` and the
+    fingerprint of each of the ``outputs``, both keyed by absolute path. If
+    the file does not exist or was written by a different version, the
+    manifest is empty.
+
+    """
+
+    manifest = {'version': manifestVersion, 'inputs': {}, 'outputs': {}}
+
+    if os.path.exists(filename):
+        try:
+            data = json.load(open(filename, 'r'))
+        except ValueError:
+            data = {}
+        if data.get('version') == manifestVersion:
+            manifest.update(data)
+
+    return manifest
+
+
+def writeManifest(filename, manifest):
+    """Saves a manifest of plPlugMapM fingerprints."""
+
+    tmpFile = filename + '.tmp{0:d}'.format(os.getpid())
+    with open(tmpFile, 'w') as unit:
+        json.dump(manifest, unit, indent=1, sort_keys=True)
+    os.rename(tmpFile, filename)
+
+
+def readPar(filename):
+    """Parses a plPlugMap file.
+
+    Returns the PLUGMAPOBJ structured array, the enums to be passed to
+    `writePar`, and the list of header lines.
+
+    """
 
     yannyFile = yanny.yanny(filename, np=True)
     rawFile = open(filename, 'r').read().splitlines()
@@ -127,36 +633,95 @@ def create_plPlugMapM_LCO(plateID, pointing, field, mjd,
             break
         header.append(line)
 
+    enums = {'holeType': ['HOLETYPE', yannyFile._enum_cache['HOLETYPE']],
+             'objType': ['OBJTYPE', yannyFile._enum_cache['OBJTYPE']]}
+
+    return plPlugMapObj, enums, header
+
+
+def readPlPlugMapP(plateID, pointing, cacheDir=None, cacheSize=cacheMaxSize,
+                   plateIndex=None):
+    """Parses the plPlugMapP file for a plate and pointing.
+
+    Returns the same values as `readPar`.
+
+    If ``cacheDir`` is set, the parsed file is stored there in binary format,
+    keyed by the path, mtime and size of the plPlugMapP, and later calls
+    load the memory-mapped array instead of parsing the file again. The
+    cache is kept under ``cacheSize`` bytes by evicting the least recently
+    used entries.
+
+    If a `PlateIndex` is passed as ``plateIndex``, it is used to find the
+    plPlugMapP file.
+
+    """
+
+    filename = findPlPlugMapP(plateID, pointing, plateIndex=plateIndex)
+
+    if cacheDir is not None:
+        key = _getCacheKey(filename)
+        cached = _readCache(cacheDir, key)
+        if cached is not None:
+            return cached
+
+    plPlugMapObj, enums, header = readPar(filename)
+
+    if cacheDir is not None:
+        _writeCache(cacheDir, key, plPlugMapObj, enums, header,
+                    maxSize=cacheSize)
+
+    return plPlugMapObj, enums, header
+
+
+def _getOutFileName(plateID, pointing, field, mjd, fscanId):
+    """Returns the name of a plPlugMapM file."""
+
+    pointingName = '' if pointing == 'A' else pointing
+
+    return 'plPlugMapM-{0}{3}-{1}-{2:02d}_{4}.par'.format(
+        plateID, mjd, fscanId, pointingName, colourDict[field])
+
+
+def getFiberIDRange(pointing, field):
+    """Returns the fiberIds of the guides for a pointing and field."""
+
+    pointingName = '' if pointing == 'A' else pointing
+
     # Calculates the range of fiberIds that correspond to this pointing
     # and fscanID.
     pointingNum = string.uppercase.index(pointingName)
     preIndex = nGuides * 3 * pointingNum
-    fiberID_range = preIndex + np.arange(1 + (field - 1) * nGuides,
-                                         1 + field * nGuides)
-    print(fiberID_range)
-    outFileName = 'plPlugMapM-{0}{3}-{1}-{2:02d}_{4}.par'.format(
-        plateID, mjd, fscanId, pointingName, colourDict[field])
+
+    return preIndex + np.arange(1 + (field - 1) * nGuides,
+                                1 + field * nGuides)
+
+
+def selectHoles(plPlugMapObj, pointing, field):
+    """Returns the light traps, alignments and guides for a field."""
+
+    fiberID_range = getFiberIDRange(pointing, field)
 
     # Gets a list of the holes that we should keep for this fscanID
     validHoles = plPlugMapObj[(plPlugMapObj['holeType'] == 'LIGHT_TRAP') |
-                              (np.in1d(plPlugMapObj['fiberId'],
+                              (np.isin(plPlugMapObj['fiberId'],
                                        fiberID_range))]
 
     lightTraps = validHoles[validHoles['holeType'] == 'LIGHT_TRAP']
     guides = validHoles[validHoles['holeType'] == 'GUIDE']
     alignments = validHoles[validHoles['holeType'] == 'ALIGNMENT']
 
-    guides = guides[lookupArray[:, 1] - 1]
-    guides['fiberId'] = lookupArray[:, 0]
+    return lightTraps, alignments, guides
 
-    sortedPlPlugMapM = np.concatenate((lightTraps, alignments, guides))
 
-    enums = {'holeType': ['HOLETYPE', yannyFile._enum_cache['HOLETYPE']],
-             'objType': ['OBJTYPE', yannyFile._enum_cache['OBJTYPE']]}
-    yanny.write_ndarray_to_yanny(outFileName, sortedPlPlugMapM, enums=enums,
-                                 structname='PLUGMAPOBJ')
+def _replaceGuidenums(header, pointing):
+    """Returns a copy of the header with the guidenums of the pointing
+    replaced with the slice used for the plPlugMapM."""
+
+    pointingName = '' if pointing == 'A' else pointing
+    pointingNum = string.uppercase.index(pointingName)
+
+    header = list(header)
 
-    # Replaces the guidenums with the slice used for this file
     for ii, line in enumerate(header):
         if line.startswith('guidenums' + str(pointingNum + 1)):
             guides = str('guidenums' + str(pointingNum + 1)) + ' ' + \
@@ -164,27 +729,446 @@ def create_plPlugMapM_LCO(plateID, pointing, field, mjd,
             header[ii] = guides
             break
 
-    addHeader(header, outFileName, plateID, fscanId, field,
-              mjd, colourDict[field])
+    return header
+
+
+def buildPlPlugMapM(plPlugMapObj, header, plateID, pointing, field, mjd,
+                    lookupArray=None, fscanId=1):
+    """Builds a plPlugMapM in memory from a parsed plPlugMapP.
+
+    Selects the light traps, alignments and guides for the ``pointing`` and
+    ``field``, reorders the guides using ``lookupArray`` (see
+    `getLookupArray`; the identity mapping if ``None``), and replaces the
+    guidenums in the header. Neither the inputs nor any file are modified.
+
+    Returns the PLUGMAPOBJ structured array of the plPlugMapM and its
+    header lines, which can be serialised with `writePar`.
+
+    """
+
+    if lookupArray is None:
+        lookupArray = getLookupArray(None)
+
+    lightTraps, alignments, guides = selectHoles(plPlugMapObj, pointing,
+                                                  field)
+
+    guides = guides[lookupArray[:, 1] - 1]
+    guides['fiberId'] = lookupArray[:, 0]
+
+    plPlugMapM = np.concatenate((lightTraps, alignments, guides))
+
+    header = getHeader(_replaceGuidenums(header, pointing), plateID, fscanId,
+                       field, mjd, colourDict[field])
+
+    return plPlugMapM, header
+
+
+def writePlPlugMapM(plPlugMapObj, enums, header, plateID, pointing, field,
+                    mjd, lookupArray, fscanId=1, output=None):
+    """Writes a plPlugMapM from an already parsed plPlugMapP.
+
+    If ``output`` is ``None``, the plPlugMapM is written to a file in the
+    current directory. Otherwise, ``output`` is passed to `writePar`.
+    Returns the name of the plPlugMapM.
+
+    """
+
+    outFileName = _getOutFileName(plateID, pointing, field, mjd, fscanId)
+
+    plPlugMapM, header = buildPlPlugMapM(plPlugMapObj, header, plateID,
+                                         pointing, field, mjd,
+                                         lookupArray=lookupArray,
+                                         fscanId=fscanId)
+
+    writePar(outFileName if output is None else output, plPlugMapM,
+             header, enums, structname='PLUGMAPOBJ')
+
+    return outFileName
+
+
+def writeSimulatedPlPlugMapMs(plPlugMapObj, enums, header, plateID, pointing,
+                              field, mjd, fibres, holes, fscanId=1,
+                              output=None):
+    """Writes a plPlugMapM for each simulated mapping.
+
+    ``fibres`` and ``holes`` are the arrays returned by
+    `simulateLookupArrays`. The guides for all the simulations are selected
+    with a single fancy-indexing operation. The n-th simulation is written
+    with fscanId ``fscanId + n``. Returns the names of the plPlugMapMs.
+
+    """
+
+    lightTraps, alignments, guides = selectHoles(plPlugMapObj, pointing,
+                                                  field)
+
+    # An (nSims, nGuides) array with the guides of each simulation.
+    simGuides = guides[holes - 1]
+    simGuides['fiberId'] = fibres
+
+    fixedHoles = np.concatenate((lightTraps, alignments))
+    header = _replaceGuidenums(header, pointing)
+
+    outFileNames = []
+    for nn in range(len(simGuides)):
+        simFscanId = fscanId + nn
+        outFileName = _getOutFileName(plateID, pointing, field, mjd,
+                                      simFscanId)
+        writePar(outFileName if output is None else output,
+                 np.concatenate((fixedHoles, simGuides[nn])),
+                 getHeader(header, plateID, simFscanId, field,
+                           mjd, colourDict[field]),
+                 enums, structname='PLUGMAPOBJ')
+        outFileNames.append(outFileName)
+
+    return outFileNames
+
+
+def create_plPlugMapM_LCO(plateID, pointing, field, mjd,
+                          lookupTable=None, fscanId=1, output=None,
+                          cacheDir=None, plateIndex=None):
+    """Converts the plPlugMapP files for a `plateID` into a plPlugMapM.
+
+    This scripts converts the plPlugMapP files for a `plateID` into a
+    plPlugMapM given a lookup table that simulates a mapping.
+
+    Each guider commissioning plate contains four pointings, each with 3
+    sets of 16 guiding stars (fields). If ``output`` is not ``None``, the
+    plPlugMapM is written to it (a filename, a file-like object, or ``'-'``
+    for stdout) instead of to the current directory. If ``cacheDir`` is
+    set, the parsed plPlugMapP is cached there (see `readPlPlugMapP`). A
+    `PlateIndex` can be passed as ``plateIndex`` to locate the plPlugMapP.
+
+    """
+
+    lookupArray = getLookupArray(lookupTable)
+
+    plPlugMapObj, enums, header = readPlPlugMapP(plateID, pointing,
+                                                 cacheDir=cacheDir,
+                                                 plateIndex=plateIndex)
+
+    writePlPlugMapM(plPlugMapObj, enums, header, plateID, pointing, field,
+                    mjd, lookupArray, fscanId=fscanId, output=output)
 
     return
 
 
+def _create_plate_plPlugMapMs(args):
+    """Creates all the requested plPlugMapM files for a single plate.
+
+    Each plPlugMapP file is parsed only once and all the fields for that
+    pointing are generated from the same table. If ``pointings`` is
+    ``None``, all the pointings for which a plPlugMapP file exists are used,
+    and an `IOError` is raised if there are none.
+
+    If there is a ``manifest``, the fields whose plPlugMapMs exist and have
+    the fingerprint of the current inputs are skipped, and a plPlugMapP is
+    only parsed if any of its fields is stale. Returns the names of the
+    files created and skipped, and the fingerprints and input hashes to add
+    to the manifest.
+
+    """
+
+    plateID, kwargs = args
+
+    pointings = kwargs['pointings']
+    fscanId = kwargs['fscanId']
+    output = kwargs['output']
+    manifest = kwargs['manifest']
+
+    lookupArray = getLookupArray(kwargs['lookupTable'])
+
+    simulation = kwargs['simulation']
+    if simulation is not None:
+        fibres, holes = simulateLookupArrays(**simulation)
+
+    plateIndex = kwargs['plateIndex']
+
+    if pointings is None and plateIndex is not None:
+        pointings = plateIndex.getPointings(plateID)
+    elif pointings is None:
+        pointings = [pointing for pointing in allPointings
+                     if os.path.exists(getPlPlugMapPPath(plateID, pointing))]
+
+    if len(pointings) == 0:
+        raise IOError('cannot find any plPlugMapP file for plate {0}'.format(
+            plateID))
+
+    # Random simulations are different every time, so they are never
+    # up to date.
+    useManifest = manifest is not None and (simulation is None or
+                                            simulation.get('seed') is not None)
+    fscanIds = ([fscanId] if simulation is None else
+                list(range(fscanId, fscanId + simulation['nSims'])))
+
+    result = {'created': [], 'skipped': [], 'outputs': {}, 'inputs': {}}
+
+    for pointing in pointings:
+
+        if useManifest:
+            plPlugMapPFile = os.path.abspath(
+                findPlPlugMapP(plateID, pointing, plateIndex=plateIndex))
+            plPlugMapPHash = _hashFile(plPlugMapPFile, manifest['inputs'])
+            result['inputs'][plPlugMapPFile] = \
+                manifest['inputs'][plPlugMapPFile]
+
+        plPlugMapP = None
+
+        for field in kwargs['fields']:
+
+            outFiles = [os.path.abspath(_getOutFileName(plateID, pointing,
+                                                        field, kwargs['mjd'],
+                                                        simFscanId))
+                        for simFscanId in fscanIds]
+
+            fingerprint = None
+            if useManifest:
+                fingerprint = _getFingerprint(
+                    plPlugMapPHash, kwargs['lookupHash'], plateID, pointing,
+                    field, kwargs['mjd'], fscanId, simulation=simulation)
+                if not kwargs['force'] and all(
+                        manifest['outputs'].get(outFile) == fingerprint and
+                        os.path.exists(outFile) for outFile in outFiles):
+                    result['skipped'] += [os.path.basename(outFile)
+                                          for outFile in outFiles]
+                    continue
+
+            if plPlugMapP is None:
+                plPlugMapP = readPlPlugMapP(plateID, pointing,
+                                            cacheDir=kwargs['cacheDir'],
+                                            cacheSize=kwargs['cacheSize'],
+                                            plateIndex=plateIndex)
+            plPlugMapObj, enums, header = plPlugMapP
+
+            if simulation is not None:
+                result['created'] += writeSimulatedPlPlugMapMs(
+                    plPlugMapObj, enums, header, plateID, pointing, field,
+                    kwargs['mjd'], fibres, holes, fscanId=fscanId,
+                    output=output)
+            else:
+                result['created'].append(
+                    writePlPlugMapM(plPlugMapObj, enums, header, plateID,
+                                    pointing, field, kwargs['mjd'],
+                                    lookupArray, fscanId=fscanId,
+                                    output=output))
+
+            if fingerprint is not None:
+                for outFile in outFiles:
+                    result['outputs'][outFile] = fingerprint
+
+    return result
+
+
+def create_plPlugMapM_LCO_batch(plateIDs, mjd, pointings=None, fields=None,
+                                lookupTable=None, fscanId=1, nProcs=None,
+                                output=None, cacheDir=None,
+                                cacheSize=cacheMaxSize, plateIndex=None,
+                                simulation=None, manifest=None, force=False):
+    """Creates the plPlugMapM files for a list of plates.
+
+    Parameters:
+        plateIDs (list):
+            The list of plateIDs to convert.
+        mjd (int):
+            The MJD of the scan.
+        pointings (list or None):
+            The pointings to convert (e.g., ``['A', 'B']``). If ``None``, all
+            the pointings with a plPlugMapP file are converted.
+        fields (list or None):
+            The fields to convert. If ``None``, all the fields in
+            ``colourDict`` are converted.
+        lookupTable (str or None):
+            The lookup table linking fibres and holes.
+        fscanId (int):
+            The fscanId to create.
+        nProcs (int or None):
+            The number of processes among which the plates are distributed.
+            If ``None``, uses as many processes as CPUs.
+        output (str, file-like or None):
+            If not ``None``, all the plPlugMapM files are written to this
+            file-like object or to stdout (``'-'``), in which case the
+            plates are processed serially.
+        cacheDir (str or None):
+            If set, the directory in which parsed plPlugMapP files are
+            cached (see `readPlPlugMapP`).
+        cacheSize (int):
+            The maximum size of the cache, in bytes.
+        plateIndex (`PlateIndex`, str or None):
+            A `PlateIndex` or the path to the file in which the index is
+            saved. The index is refreshed and saved before processing the
+            plates. If ``None``, the paths are built from ``PLATELIST_DIR``.
+        simulation (dict or None):
+            If set, a dictionary of arguments for `simulateLookupArrays`.
+            The simulated mappings are written for each plate, pointing and
+            field instead of the one defined by ``lookupTable``.
+        manifest (str or None):
+            If set, the file in which the fingerprint of the inputs of each
+            plPlugMapM is kept: the contents of the plPlugMapP and the lookup
+            table, and the arguments. plPlugMapMs that exist and whose
+            fingerprint has not changed are skipped, and listed in stderr.
+            Ignored if ``output`` is set.
+        force (bool):
+            If ``True``, all the plPlugMapMs are created even if they are up
+            to date. The manifest is still updated.
+
+    Returns:
+        A list with the names of all the plPlugMapM files created.
+
+    """
+
+    fields = sorted(colourDict.keys()) if fields is None else list(fields)
+    pointings = None if pointings is None else list(pointings)
+
+    if plateIndex is not None:
+        if not isinstance(plateIndex, PlateIndex):
+            plateIndex = PlateIndex(plateIndex)
+        plateIndex.refresh(plateIDs=plateIDs)
+        plateIndex.save()
+
+    manifestData = None
+    lookupHash = None
+    if manifest is not None and output is None:
+        manifestData = readManifest(manifest)
+        lookupHash = ('identity' if lookupTable is None
+                      else _hashFile(lookupTable, manifestData['inputs']))
+
+    kwargs = dict(pointings=pointings, fields=fields, mjd=mjd,
+                  lookupTable=lookupTable, fscanId=fscanId, output=output,
+                  cacheDir=cacheDir, cacheSize=cacheSize,
+                  plateIndex=plateIndex, simulation=simulation,
+                  manifest=manifestData, lookupHash=lookupHash, force=force)
+
+    tasks = [(plateID, kwargs) for plateID in plateIDs]
+
+    nProcs = nProcs or multiprocessing.cpu_count()
+    nProcs = min(nProcs, len(tasks)) if output is None else 1
+
+    if nProcs <= 1:
+        results = list(map(_create_plate_plPlugMapMs, tasks))
+    else:
+        pool = multiprocessing.Pool(nProcs)
+        try:
+            results = pool.map(_create_plate_plPlugMapMs, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    skipped = [outFile for result in results for outFile in result['skipped']]
+
+    if manifestData is not None:
+        for result in results:
+            manifestData['inputs'].update(result['inputs'])
+            manifestData['outputs'].update(result['outputs'])
+        writeManifest(manifest, manifestData)
+
+    for outFile in skipped:
+        print('{0} is up to date'.format(outFile), file=sys.stderr)
+    if len(skipped) > 0:
+        print('Skipped {0} up-to-date plPlugMapM files.'.format(len(skipped)),
+              file=sys.stderr)
+
+    return [outFile for result in results for outFile in result['created']]
+
+
+def parsePlateIDs(plateIDs):
+    """Parses a string of plateIDs such as ``'8000-8003,8010'`` into a list."""
+
+    parsed = []
+    for chunk in plateIDs.split(','):
+        if '-' in chunk:
+            start, end = chunk.split('-')
+            parsed += list(range(int(start), int(end) + 1))
+        else:
+            parsed.append(int(chunk))
+
+    return parsed
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]))
 
-    parser.add_argument('PLATEID', type=int, help='The plateID.')
-    parser.add_argument('POINTING', type=str, help='The pointing.')
-    parser.add_argument('FIELD', type=int, help='The field to map.')
+    parser.add_argument('PLATEID', type=str,
+                        help='The plateID. Can be a list or range of plates '
+                             '(e.g., 8000-8003,8010).')
+    parser.add_argument('POINTING', type=str,
+                        help='The pointing. Can be a list of pointings '
+                             '(e.g., ABD) or "all".')
+    parser.add_argument('FIELD', type=str,
+                        help='The field to map. Can be a list of fields '
+                             '(e.g., 12) or "all".')
     parser.add_argument('MJD', type=int, help='The MJD of the scan.')
     parser.add_argument('--lookupTable', '-l', metavar='lookupTable',
                         type=str, default=None,
                         help='The lookup table linking fibres and holes.')
     parser.add_argument('--fscanId', '-f', metavar='fscanId',
                         type=int, default=1, help='The fscanId to create.')
+    parser.add_argument('--nprocs', '-n', metavar='nprocs',
+                        type=int, default=None,
+                        help='The number of processes to use in batch mode.')
+    parser.add_argument('--stdout', action='store_true', default=False,
+                        help='Writes the plPlugMapM files to stdout.')
+    parser.add_argument('--cacheDir', '-c', metavar='cacheDir',
+                        type=str, default=None,
+                        help='A directory in which to cache the parsed '
+                             'plPlugMapP files.')
+    parser.add_argument('--cacheSize', metavar='cacheSize',
+                        type=int, default=cacheMaxSize // 1024**2,
+                        help='The maximum size of the cache, in MB.')
+    parser.add_argument('--plateIndex', '-i', metavar='plateIndex',
+                        type=str, default=None,
+                        help='A file in which to keep an index of the '
+                             'plPlugMap files under PLATELIST_DIR.')
+    parser.add_argument('--simulate', '-s', metavar='nSims',
+                        type=int, default=None,
+                        help='Writes nSims simulated mappings for each '
+                             'field instead of using the lookup table.')
+    parser.add_argument('--simMode', type=str, default='random',
+                        choices=['identity', 'shift', 'random'],
+                        help='How fibres are assigned to holes in the '
+                             'simulated mappings.')
+    parser.add_argument('--swapped', type=int, default=0,
+                        help='The number of pairs of swapped fibres in each '
+                             'simulated mapping.')
+    parser.add_argument('--missing', type=int, default=0,
+                        help='The number of missing fibres in each simulated '
+                             'mapping.')
+    parser.add_argument('--broken', type=str, default=None,
+                        help='A comma-separated list of broken fibres.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='The seed for the simulated mappings.')
+    parser.add_argument('--manifest', '-m', metavar='manifest',
+                        type=str, nargs='?', default=None,
+                        const=manifestFile,
+                        help='The file in which to keep the fingerprints of '
+                             'the inputs of each plPlugMapM, so that the '
+                             'ones that are up to date are not recreated. '
+                             'Defaults to {0} if no file is given. If not '
+                             'set, all the plPlugMapMs are created.'.format(
+                                 manifestFile))
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Recreates all the plPlugMapM files, even if '
+                             'they are up to date.')
 
     args = parser.parse_args()
 
-    create_plPlugMapM_LCO(args.PLATEID, args.POINTING, args.FIELD, args.MJD,
-                          lookupTable=args.lookupTable, fscanId=args.fscanId)
+    plateIDs = parsePlateIDs(args.PLATEID)
+    pointings = None if args.POINTING == 'all' else list(args.POINTING)
+    fields = None if args.FIELD == 'all' else list(map(int, args.FIELD))
+
+    simulation = None
+    if args.simulate is not None:
+        brokenFibres = (None if args.broken is None
+                        else list(map(int, args.broken.split(','))))
+        simulation = dict(nSims=args.simulate, mode=args.simMode,
+                          nSwapped=args.swapped, nMissing=args.missing,
+                          brokenFibres=brokenFibres, seed=args.seed)
+
+    create_plPlugMapM_LCO_batch(plateIDs, args.MJD, pointings=pointings,
+                                fields=fields, lookupTable=args.lookupTable,
+                                fscanId=args.fscanId, nProcs=args.nprocs,
+                                output='-' if args.stdout else None,
+                                cacheDir=args.cacheDir,
+                                cacheSize=args.cacheSize * 1024**2,
+                                plateIndex=args.plateIndex,
+                                simulation=simulation,
+                                manifest=args.manifest, force=args.force)
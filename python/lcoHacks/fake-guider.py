@@ -19,6 +19,7 @@ from opscore.utility.sdss3logging import setupRootLogger, setConsoleLevel
 import logging
 
 import opscore.protocols.keys as keys
+import opscore.protocols.types as types
 import opscore.protocols.validation as validation
 
 import actorcore.CommandLinkManager as cmdLinkManager
@@ -28,20 +29,1495 @@ import actorcore.CmdrConnection
 import ConfigParser
 import Queue
 
-from twisted.internet import reactor
+from twisted.internet import reactor, task, threads
+from twisted.python.threadpool import ThreadPool
 
+import argparse
+import bisect
+import collections
+import copy
+import datetime
+import functools
+import gzip
 import imp
 import inspect
+import io
+import json
+import numpy as np
 import os
 import re
 import sys
+import tempfile
 import threading
+import time
 import traceback
 
 
+class BroadcastScheduler(object):
+    """Calls a function at a fixed cadence from the reactor thread.
+
+    The calls are scheduled by a `~twisted.internet.task.LoopingCall`, which
+    times each call from the moment the scheduler was started, so the cadence
+    does not drift, and skips the calls it missed instead of piling them up.
+    `.start`, `.stop` and `.setCadence` can be called from any thread.
+
+    """
+
+    def __init__(self, func, cadence, logger=None):
+
+        self.func = func
+        self.cadence = float(cadence)
+        self.logger = logger or logging.getLogger('actor')
+
+        self._loop = task.LoopingCall(self._call)
+
+    @property
+    def running(self):
+        return self._loop.running
+
+    def _call(self):
+        """Calls the function, making sure an exception does not stop the loop."""
+
+        try:
+            self.func()
+        except Exception as e:
+            self.logger.warn('broadcast failed: %s' % (e))
+
+    def _start(self, now=True):
+        if self._loop.running:
+            self._loop.stop()
+        self._loop.start(self.cadence, now=now)
+
+    def _stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def start(self, cadence=None, now=True):
+        """Starts (or restarts) the broadcasts, optionally with a new cadence."""
+
+        if cadence is not None:
+            self.setCadence(cadence, restart=False)
+        reactor.callFromThread(self._start, now)
+
+    def stop(self):
+        """Stops the broadcasts."""
+
+        reactor.callFromThread(self._stop)
+
+    def setCadence(self, cadence, restart=True):
+        """Changes the cadence, restarting the loop if it is running."""
+
+        cadence = float(cadence)
+        if cadence <= 0:
+            raise ValueError('the cadence must be positive')
+
+        self.cadence = cadence
+        if restart and self.running:
+            reactor.callFromThread(self._start, False)
+
+
+class KeywordStream(object):
+    """Broadcasts a synthetic stream of guider keywords at a fixed rate.
+
+    The keywords for ``nFrames`` guider frames are generated in advance with
+    numpy and formatted only once, so sending them costs no more than the
+    output itself. The frames are cycled through forever. Every ``tick``
+    seconds the stream sends, as one batch, the messages that are due for
+    ``rate`` messages per second since it was started.
+
+    """
+
+    fiberDataTemplate = ('fiberData=%d,"%s",%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,'
+                         '%.2f,%.2f,%.3f,%d')
+    guideRMSTemplate = ('guideRMS=%d,%.3f,%d,%d,%.4f,%.4f,%.4f,%d,%d,%d,%d')
+    axisErrorTemplate = 'axisError=%.3f,%.3f,%.3f'
+    axisChangeTemplate = 'axisChange=%.3f,%.3f,%.3f,"OK"'
+    focusErrorTemplate = 'focusError=%.1f'
+    focusChangeTemplate = 'focusChange=%.1f,"OK"'
+    scaleErrorTemplate = 'scaleError=%.3e'
+
+    def __init__(self, send, rate=100., tick=0.05, nFrames=256, nGuides=16,
+                 seed=None, logger=None):
+
+        self.send = send
+        self.rate = float(rate)
+        self.maxBatch = int(self.rate * tick * 10) + 1
+        self.messages = self.makeMessages(nFrames, nGuides, seed=seed)
+
+        self.nSent = 0
+        self._index = 0
+        self._startTime = None
+        self._nDue = 0
+
+        self.scheduler = BroadcastScheduler(self._tick, tick, logger=logger)
+
+    @classmethod
+    def makeMessages(cls, nFrames, nGuides=16, seed=None):
+        """Returns the formatted keywords for ``nFrames`` synthetic frames."""
+
+        rng = np.random.RandomState(seed)
+
+        fiberIds = np.arange(1, nGuides + 1)
+        fiberTypes = np.where(fiberIds % 8 == 4, 'ACQUIRE', 'GUIDE')
+
+        # Each guide fibre has a fixed position and drifts randomly around it.
+        angles = 2 * np.pi * fiberIds / nGuides
+        xFocal = np.tile(300 * np.cos(angles), (nFrames, 1))
+        yFocal = np.tile(300 * np.sin(angles), (nFrames, 1))
+        dx = np.cumsum(rng.normal(0, 0.01, (nFrames, nGuides)), axis=0)
+        dy = np.cumsum(rng.normal(0, 0.01, (nFrames, nGuides)), axis=0)
+        dRA = dx * 16.5
+        dDec = dy * 16.5
+        fwhm = rng.normal(1.2, 0.1, (nFrames, nGuides)).clip(0.5)
+        flux = rng.normal(5000, 500, (nFrames, nGuides)).clip(0)
+        mag = 25 - 2.5 * np.log10(flux + 1)
+        enabled = (rng.uniform(size=(nFrames, nGuides)) > 0.02).astype(int)
+
+        rms = np.sqrt(np.mean(dx**2 + dy**2, axis=1))
+        axisError = rng.normal(0, 0.2, (nFrames, 3))
+        axisChange = -0.7 * axisError
+        focusError = rng.normal(0, 20, nFrames)
+        scaleError = rng.normal(0, 1e-5, nFrames)
+
+        messages = []
+        for frame in range(nFrames):
+            for ii in range(nGuides):
+                messages.append(cls.fiberDataTemplate %
+                                (fiberIds[ii], fiberTypes[ii],
+                                 xFocal[frame, ii], yFocal[frame, ii],
+                                 dx[frame, ii], dy[frame, ii],
+                                 dRA[frame, ii], dDec[frame, ii],
+                                 fwhm[frame, ii], mag[frame, ii],
+                                 flux[frame, ii], enabled[frame, ii]))
+            messages.append(cls.guideRMSTemplate %
+                            (frame, rms[frame], nGuides, enabled[frame].sum(),
+                             rms[frame], axisError[frame, 0], axisError[frame, 1],
+                             0, 0, 0, 0))
+            messages.append(cls.axisErrorTemplate % tuple(axisError[frame]))
+            messages.append(cls.axisChangeTemplate % tuple(axisChange[frame]))
+            messages.append(cls.focusErrorTemplate % focusError[frame])
+            messages.append(cls.focusChangeTemplate % (-0.7 * focusError[frame]))
+            messages.append(cls.scaleErrorTemplate % scaleError[frame])
+
+        return messages
+
+    @property
+    def running(self):
+        return self.scheduler.running
+
+    def _tick(self):
+        """Sends the messages due since the last tick."""
+
+        now = time.time()
+        if self._startTime is None:
+            self._startTime = now
+            self._nDue = 0
+
+        nDue = int((now - self._startTime) * self.rate)
+        nBatch = nDue - self._nDue
+
+        # After a long stall of the reactor, do not try to catch up in one go.
+        if nBatch > self.maxBatch:
+            nBatch = self.maxBatch
+            self._startTime = now - self.maxBatch / self.rate
+            nDue = self.maxBatch
+        self._nDue = nDue
+
+        nMessages = len(self.messages)
+        for ii in range(nBatch):
+            self.send(self.messages[(self._index + ii) % nMessages])
+
+        self._index = (self._index + nBatch) % nMessages
+        self.nSent += nBatch
+
+    def start(self, rate=None):
+        """Starts the stream, optionally with a new rate in messages per second."""
+
+        if rate is not None:
+            if float(rate) <= 0:
+                raise ValueError('the rate must be positive')
+            self.rate = float(rate)
+            self.maxBatch = int(self.rate * self.scheduler.cadence * 10) + 1
+
+        self._startTime = None
+        self.scheduler.start()
+
+    def stop(self):
+        """Stops the stream."""
+
+        self.scheduler.stop()
+
+
+def getMJD():
+    """Returns the current MJD."""
+
+    return int(time.time() / 86400. + 40587.)
+
+
+def getGimgPath(gimgDir, frameNumber, mjd=None):
+    """Returns the directory and file name of a proc-gimg frame."""
+
+    mjd = getMJD() if mjd is None else mjd
+
+    return (os.path.join(gimgDir, str(mjd)),
+            'proc-gimg-{0:04d}.fits.gz'.format(frameNumber))
+
+
+def _fitsCard(key, value, comment=None):
+    """Returns an 80-character FITS header card."""
+
+    if isinstance(value, bool):
+        valueStr = '%20s' % ('T' if value else 'F')
+    elif isinstance(value, (int, np.integer)):
+        valueStr = '%20d' % value
+    elif isinstance(value, (float, np.floating)):
+        valueStr = '%20s' % repr(float(value))
+    else:
+        valueStr = "'%-8s'" % str(value).replace("'", "''")
+
+    card = '%-8s= %s' % (key, valueStr)
+    if comment:
+        card = '%-30s / %s' % (card, comment)
+
+    return card[:80].ljust(80)
+
+
+def _fitsPad(data, fill):
+    """Pads a FITS header or data unit to a multiple of 2880 bytes."""
+
+    return data + fill * (-len(data) % 2880)
+
+
+class ProcGimgWriter(object):
+    """Writes synthetic gzipped proc-gimg frames in a pool of threads.
+
+    A few noisy images with a star in each guide fibre are created and
+    converted to FITS data units at start-up, and every frame reuses one of
+    them with a new header. The header is written by hand and the frame is
+    compressed in a `~twisted.python.threadpool.ThreadPool`, so the reactor is
+    never blocked; gzip releases the GIL, so ``nThreads`` controls how many
+    frames per second can be written. Each frame is written to a temporary
+    file and renamed, so readers never see a partial file.
+
+    """
+
+    def __init__(self, gimgDir, size=1024, nBuffers=4, nThreads=2,
+                 compressLevel=1, maxPending=None, nGuides=16, seed=None,
+                 logger=None):
+
+        self.gimgDir = gimgDir
+        self.size = size
+        self.compressLevel = compressLevel
+        self.maxPending = maxPending if maxPending is not None else 2 * nThreads
+        self.logger = logger or logging.getLogger('actor')
+
+        rng = np.random.RandomState(seed)
+        self.dataUnits = [self.makeDataUnit(size, nGuides, rng)
+                          for ii in range(nBuffers)]
+
+        self.nPending = 0
+        self.nWritten = 0
+        self.nDropped = 0
+
+        self.pool = ThreadPool(minthreads=1, maxthreads=nThreads,
+                               name='procGimgWriter')
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+
+    @staticmethod
+    def makeDataUnit(size, nGuides, rng):
+        """Returns the padded, big-endian FITS data of a synthetic frame."""
+
+        image = rng.normal(1000, 10, (size, size))
+
+        # One star in the middle of each fibre, with the fibres in a ring.
+        yy, xx = np.mgrid[-8:9, -8:9]
+        star = 5000 * np.exp(-(xx**2 + yy**2) / (2 * 2.**2))
+        angles = 2 * np.pi * np.arange(nGuides) / nGuides
+        for angle in angles:
+            xc = int(size / 2 + 0.35 * size * np.cos(angle))
+            yc = int(size / 2 + 0.35 * size * np.sin(angle))
+            image[yc - 8:yc + 9, xc - 8:xc + 9] += star * rng.uniform(0.5, 1.5)
+
+        data = image.clip(0, 32767).astype('>i2').tobytes()
+
+        return _fitsPad(data, b'\0')
+
+    def makeHeader(self, filename, frameNumber, mjd):
+        """Returns the padded FITS header for a frame."""
+
+        cards = [_fitsCard('SIMPLE', True, 'conforms to FITS standard'),
+                 _fitsCard('BITPIX', 16, 'array data type'),
+                 _fitsCard('NAXIS', 2, 'number of array dimensions'),
+                 _fitsCard('NAXIS1', self.size),
+                 _fitsCard('NAXIS2', self.size),
+                 _fitsCard('IMAGETYP', 'object', 'Image type'),
+                 _fitsCard('FILENAME', filename, 'File name'),
+                 _fitsCard('SEQNUM', frameNumber, 'Frame number'),
+                 _fitsCard('MJD', mjd, 'MJD of the observation'),
+                 _fitsCard('DATE-OBS', time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+                           'UTC date of the observation'),
+                 _fitsCard('EXPTIME', 1.0, 'Exposure time [s]'),
+                 _fitsCard('FAKE', True, 'Written by the fake guider'),
+                 'END'.ljust(80)]
+
+        return _fitsPad(''.join(cards).encode('ascii'), b' ')
+
+    def _write(self, dirname, filename, header, dataUnit):
+        """Compresses and writes a frame. Runs in the thread pool."""
+
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+
+        path = os.path.join(dirname, filename)
+        tmpPath = os.path.join(dirname, '.' + filename + '.tmp')
+
+        with open(tmpPath, 'wb') as unit:
+            with gzip.GzipFile(filename=filename[:-3], mode='wb', fileobj=unit,
+                               compresslevel=self.compressLevel) as gzUnit:
+                gzUnit.write(header)
+                gzUnit.write(dataUnit)
+
+        os.rename(tmpPath, path)
+
+        return dirname, filename
+
+    def _done(self, result):
+        self.nPending -= 1
+        self.nWritten += 1
+        return result
+
+    def _failed(self, failure):
+        self.nPending -= 1
+        self.logger.warn('failed writing a proc-gimg frame: %s' %
+                         (failure.getErrorMessage()))
+        return failure
+
+    def write(self, frameNumber):
+        """Writes a frame. Must be called from the reactor thread.
+
+        Returns a `~twisted.internet.defer.Deferred` that fires with the
+        directory and file name of the frame once it is on disk, or ``None``
+        if the frame was dropped because too many frames are pending.
+
+        """
+
+        if self.nPending >= self.maxPending:
+            self.nDropped += 1
+            return None
+
+        mjd = getMJD()
+        dirname, filename = getGimgPath(self.gimgDir, frameNumber, mjd=mjd)
+        header = self.makeHeader(filename[:-3], frameNumber, mjd)
+        dataUnit = self.dataUnits[frameNumber % len(self.dataUnits)]
+
+        self.nPending += 1
+        deferred = threads.deferToThreadPool(reactor, self.pool, self._write,
+                                             dirname, filename, header, dataUnit)
+
+        return deferred.addCallbacks(self._done, self._failed)
+
+
+# Matches the replies in an actor or hub log: a timestamp, the name of the
+# actor, the command and message ids, the flag and the keywords.
+replayRe = re.compile(r'^(?P<timestamp>\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?)Z?\s'
+                      r'(?:.*\s)?(?P<actor>\S+)\s+\d+\s+\d+\s+(?P<flag>[iwd])\s+'
+                      r'(?P<keywords>\S.*)$')
+
+epoch = datetime.datetime(1970, 1, 1)
+
+
+def readReplayLog(path, pattern=replayRe, actor=None):
+    """Yields the replies in a log as ``(time, flag, keywords)``.
+
+    The log, which can be gzipped, is read lazily one line at a time.
+    ``pattern`` must define the ``timestamp``, ``flag`` and ``keywords``
+    groups and, to select the replies of a single ``actor``, the ``actor``
+    group. Lines that do not match are skipped.
+
+    """
+
+    if path.endswith('.gz'):
+        unit = io.TextIOWrapper(gzip.open(path, 'rb'), errors='replace')
+    else:
+        unit = io.open(path, 'rt', errors='replace')
+
+    lastSeconds = None
+    lastTime = None
+
+    with unit:
+        for line in unit:
+
+            match = pattern.match(line.rstrip())
+            if match is None:
+                continue
+
+            if actor is not None and not match.group('actor').endswith(actor):
+                continue
+
+            # Most consecutive lines share the same second, so it is parsed
+            # only when it changes.
+            timestamp = match.group('timestamp')
+            seconds = timestamp[:19]
+            if seconds != lastSeconds:
+                lastSeconds = seconds
+                lastTime = (datetime.datetime.strptime(seconds.replace('T', ' '),
+                                                       '%Y-%m-%d %H:%M:%S') -
+                            epoch).total_seconds()
+            fraction = float('0.' + timestamp[20:]) if len(timestamp) > 20 else 0.
+
+            yield lastTime + fraction, match.group('flag'), match.group('keywords')
+
+
+class KeywordReplay(object):
+    """Replays the replies recorded in an actor or hub log.
+
+    The log is streamed with `readReplayLog`. Each reply is sent when
+    ``speed`` times the time since the start of the replay reaches its time
+    since the first reply, so ``speed=10`` replays ten times faster than it
+    was recorded. With ``speed=0`` the replies are sent as fast as possible,
+    ``batchSize`` at a time, handing control back to the reactor between
+    batches. ``send`` is called with the flag and the keywords of each reply.
+    `.start` and `.stop` can be called from any thread.
+
+    """
+
+    def __init__(self, send, speed=1., batchSize=1000, pattern=replayRe,
+                 actor=None, logger=None):
+
+        self.send = send
+        self.speed = float(speed)
+        self.batchSize = batchSize
+        self.pattern = pattern
+        self.actor = actor
+        self.logger = logger or logging.getLogger('actor')
+
+        self.path = None
+        self.nSent = 0
+
+        self._replies = None
+        self._next = None
+        self._call = None
+        self._startTime = None
+        self._firstTime = None
+
+    @property
+    def running(self):
+        return self._replies is not None
+
+    def _start(self, path, speed):
+
+        self._stop()
+
+        self.path = path
+        if speed is not None:
+            self.speed = float(speed)
+
+        self.nSent = 0
+        self._replies = readReplayLog(path, pattern=self.pattern, actor=self.actor)
+        self._next = next(self._replies, None)
+        if self._next is None:
+            self.logger.warn('no replies to replay in %s' % (path))
+            self._stop()
+            return
+
+        self._startTime = time.time()
+        self._firstTime = self._next[0]
+
+        self.logger.info('replaying %s at speed %g' % (path, self.speed))
+        self._sendDue()
+
+    def _stop(self):
+
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+        if self._replies is not None:
+            self._replies.close()
+        self._replies = None
+        self._next = None
+
+    def _sendDue(self):
+        """Sends the replies that are due and schedules the next call."""
+
+        self._call = None
+
+        try:
+            if self.speed > 0:
+                now = (time.time() - self._startTime) * self.speed + self._firstTime
+            else:
+                now = None
+
+            nBatch = 0
+            while self._next is not None and nBatch < self.batchSize:
+                if now is not None and self._next[0] > now:
+                    break
+                self.send(self._next[1], self._next[2])
+                nBatch += 1
+                self._next = next(self._replies, None)
+
+        except Exception as e:
+            self.logger.warn('replay of %s failed: %s' % (self.path, e))
+            self._stop()
+            return
+
+        self.nSent += nBatch
+
+        if self._next is None:
+            self.logger.info('finished replaying %d replies from %s' % (self.nSent, self.path))
+            self._stop()
+        elif now is None or nBatch == self.batchSize:
+            self._call = reactor.callLater(0, self._sendDue)
+        else:
+            delay = (self._next[0] - now) / self.speed
+            self._call = reactor.callLater(max(delay, 0), self._sendDue)
+
+    def start(self, path, speed=None):
+        """Starts replaying a log, optionally with a new speed."""
+
+        if speed is not None and float(speed) < 0:
+            raise ValueError('the speed cannot be negative')
+
+        reactor.callFromThread(self._start, path, speed)
+
+    def stop(self):
+        """Stops the replay."""
+
+        reactor.callFromThread(self._stop)
+
+
+def _parseLimits(value):
+    """Parses comma-separated ``name:limit`` pairs into a dictionary."""
+
+    limits = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            name, limit = item.split(':')
+            limits[name.strip()] = int(limit)
+
+    return limits
+
+
+class ConcurrencyLimiter(object):
+    """Limits how many commands with the same key can run at once.
+
+    The keys of a command are its verb and its command set, each of which may
+    have a limit. A command that would go over a limit is held back instead
+    of blocking the worker that took it, and is handed over to the worker
+    that frees the slot it is waiting for.
+
+    """
+
+    def __init__(self, limits=None):
+
+        self.limits = dict(limits or {})
+
+        self._running = collections.defaultdict(int)
+        self._held = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def getKeys(self, verb, cmdSet):
+        """Returns the keys of a command that have a limit."""
+
+        return [key for key in (('verb', verb), ('cmdSet', cmdSet))
+                if key[1] in self.limits.get(key[0], {})]
+
+    def _getFullKey(self, keys):
+        """Returns the first key that has reached its limit, or ``None``."""
+
+        for key in keys:
+            if self._running[key] >= self.limits[key[0]][key[1]]:
+                return key
+
+        return None
+
+    def acquire(self, keys, item):
+        """Takes a slot for each key.
+
+        Returns ``False``, holding the item until a slot is released, if any
+        of the keys is at its limit.
+
+        """
+
+        with self._lock:
+            fullKey = self._getFullKey(keys)
+            if fullKey is not None:
+                self._held[fullKey].append((keys, item))
+                return False
+
+            for key in keys:
+                self._running[key] += 1
+
+            return True
+
+    def release(self, keys):
+        """Frees the slots of the keys.
+
+        Returns the keys and item of a held command that can run now, having
+        taken its slots, or ``None``.
+
+        """
+
+        with self._lock:
+            for key in keys:
+                self._running[key] -= 1
+
+            for key in keys:
+                held = self._held.get(key)
+                while held:
+                    heldKeys, item = held[0]
+                    fullKey = self._getFullKey(heldKeys)
+                    if fullKey is None:
+                        held.popleft()
+                        for heldKey in heldKeys:
+                            self._running[heldKey] += 1
+                        return heldKeys, item
+                    elif fullKey != key:
+                        # Now waiting for a different slot.
+                        held.popleft()
+                        self._held[fullKey].append((heldKeys, item))
+                    else:
+                        break
+
+        return None
+
+
+class MatchCache(object):
+    """A thread-safe LRU cache of the matches of command strings.
+
+    Holds up to ``maxSize`` results of `validation.CommandHandler.match`,
+    keyed by the raw command string. The validated command in a result is
+    shared by every command with the same string, so command functions must
+    not modify it.
+
+    Each `clear` starts a new generation. `get` returns the generation with
+    the match, and `put` ignores matches made in an older generation, which
+    may come from commands that have since been replaced.
+
+    """
+
+    def __init__(self, maxSize=256):
+
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, cmdStr):
+        """Returns the cached match of a command string, or ``None``, and the generation."""
+
+        with self._lock:
+            result = self._cache.pop(cmdStr, None)
+            if result is None:
+                self.misses += 1
+                return None, self.generation
+
+            self._cache[cmdStr] = result
+            self.hits += 1
+
+            return result, self.generation
+
+    def put(self, cmdStr, result, generation):
+        """Caches a match, evicting the least recently used one if full.
+
+        The match is dropped if the cache has been cleared since
+        ``generation``.
+        """
+
+        if self.maxSize <= 0:
+            return
+
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._cache.pop(cmdStr, None)
+            self._cache[cmdStr] = result
+            while len(self._cache) > self.maxSize:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        """Empties the cache, for instance after the commands have changed."""
+
+        with self._lock:
+            self._cache.clear()
+            self.generation += 1
+
+
+class LatencyHistogram(object):
+    """A histogram of latencies, in seconds, with logarithmic bins.
+
+    The bins go from 10 us to 100 s with four bins per decade. Latencies
+    beyond the last edge go into an overflow bin. Percentiles are the upper
+    edge of the bin where they fall.
+
+    """
+
+    edges = [1e-5 * 10 ** (ii / 4.) for ii in range(29)]
+
+    def __init__(self):
+
+        self.counts = [0] * (len(self.edges) + 1)
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.n += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n > 0 else 0.
+
+    def percentile(self, percent):
+        """Returns the upper edge of the bin of a percentile."""
+
+        target = percent / 100. * self.n
+        cumulative = 0
+        for ii, count in enumerate(self.counts):
+            cumulative += count
+            if count > 0 and cumulative >= target:
+                return min(self.edges[ii], self.max) if ii < len(self.edges) else self.max
+
+        return 0.
+
+    def toDict(self):
+        return {'n': self.n, 'mean': self.mean, 'max': self.max,
+                'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99), 'edges': self.edges, 'counts': self.counts}
+
+
+class PerfStats(object):
+    """Performance statistics of the actor.
+
+    Keeps, for each verb, histograms of the time commands waited in the
+    queue and of the time they took to run. It also tracks the depth of the
+    command queue and the number of broadcast messages and, if a ``fanout``
+    is given, reports its statistics too.
+
+    """
+
+    def __init__(self, commandQueue=None, fanout=None):
+
+        self.commandQueue = commandQueue
+        self.fanout = fanout
+        self.startupTime = None
+        self._lock = threading.Lock()
+
+        self.reset()
+
+    def reset(self):
+
+        with self._lock:
+            self.startTime = time.time()
+            self.waitTimes = collections.defaultdict(LatencyHistogram)
+            self.runTimes = collections.defaultdict(LatencyHistogram)
+            self.maxQueueDepth = 0
+            self.nBroadcast = 0
+
+            self._rateTime = self.startTime
+            self._rateCount = 0
+            self.broadcastRate = 0.
+
+    def queued(self, cmd):
+        """Timestamps a command as it is queued."""
+
+        cmd.perfQueued = time.time()
+
+    def sampleQueueDepth(self):
+        """Updates the maximum depth of the command queue."""
+
+        if self.commandQueue is not None:
+            depth = self.commandQueue.qsize()
+            if depth > self.maxQueueDepth:
+                self.maxQueueDepth = depth
+
+    def addCommand(self, verb, queued, started, finished):
+        """Records when a command was queued, started and finished."""
+
+        with self._lock:
+            self.waitTimes[verb].add(started - queued)
+            self.runTimes[verb].add(finished - started)
+
+    def addBroadcast(self, nMessages=1):
+        """Counts broadcast messages. Can be called from any thread."""
+
+        with self._lock:
+            self.nBroadcast += nMessages
+
+    def getBroadcastRate(self):
+        """Returns the broadcast messages per second, updated at most once a second."""
+
+        with self._lock:
+            now = time.time()
+            if now - self._rateTime >= 1:
+                nBroadcast = self.nBroadcast
+                self.broadcastRate = (nBroadcast - self._rateCount) / (now - self._rateTime)
+                self._rateTime = now
+                self._rateCount = nBroadcast
+
+            return self.broadcastRate
+
+    def getQueueDepth(self):
+        return self.commandQueue.qsize() if self.commandQueue is not None else 0
+
+    def getKeywords(self):
+        """Returns the statistics as a list of keywords, with times in ms."""
+
+        keywords = ['perfStartup=%.3f' % (self.startupTime or 0.),
+                    'perfQueue=%d,%d' % (self.getQueueDepth(), self.maxQueueDepth),
+                    'perfBroadcast=%.1f,%d' % (self.getBroadcastRate(), self.nBroadcast)]
+
+        with self._lock:
+            for verb in sorted(self.runTimes):
+                wait = self.waitTimes[verb]
+                run = self.runTimes[verb]
+                keywords.append('perfVerb=%s,%d,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f' %
+                                (qstr(verb), run.n,
+                                 1e3 * wait.mean, 1e3 * wait.percentile(50),
+                                 1e3 * wait.percentile(95), 1e3 * wait.max,
+                                 1e3 * run.mean, 1e3 * run.percentile(50),
+                                 1e3 * run.percentile(95), 1e3 * run.max))
+
+        if self.fanout is not None:
+            keywords += self.fanout.getKeywords()
+
+        return keywords
+
+    def toDict(self):
+        """Returns the statistics as a dictionary, with times in seconds."""
+
+        with self._lock:
+            verbs = dict((verb, {'wait': self.waitTimes[verb].toDict(),
+                                 'run': self.runTimes[verb].toDict()})
+                         for verb in self.runTimes)
+
+        return {'time': time.time(), 'uptime': time.time() - self.startTime,
+                'startupTime': self.startupTime,
+                'queueDepth': self.getQueueDepth(), 'maxQueueDepth': self.maxQueueDepth,
+                'broadcastRate': self.getBroadcastRate(), 'nBroadcast': self.nBroadcast,
+                'fanout': self.fanout.toDict() if self.fanout is not None else None,
+                'verbs': verbs}
+
+    def dump(self, path):
+        """Writes the statistics to a JSON file."""
+
+        with open(path, 'w') as unit:
+            json.dump(self.toDict(), unit, indent=2, sort_keys=True)
+
+
+class QueueLogHandler(logging.Handler):
+    """Hands log records to a writer thread through a bounded queue.
+
+    The message of each record is merged with its arguments, and any
+    traceback rendered, when it is queued, as `logging.handlers.QueueHandler`
+    does; the records are laid out and written by ``handlers`` in the writer
+    thread. When the queue is full, records are dropped (and the number
+    dropped is logged later) or, if ``block``, the caller waits. `.close`
+    writes the records still in the queue, and the final number dropped,
+    before returning.
+
+    """
+
+    def __init__(self, handlers, maxSize=10000, block=False):
+
+        logging.Handler.__init__(self)
+
+        self.handlers = list(handlers)
+        self.block = block
+
+        self.nDropped = 0
+        self._droppedLock = threading.Lock()
+
+        self.queue = Queue.Queue(maxSize)
+        self._thread = threading.Thread(target=self._write, name='logWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prepare(self, record):
+        """Returns a copy of a record with its final message and no arguments or traceback.
+
+        The arguments may change, and the traceback go away, before the
+        writer thread gets to the record.
+        """
+
+        msg = self.format(record)
+
+        record = copy.copy(record)
+        record.message = msg
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+
+        return record
+
+    def emit(self, record):
+
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        if self.block:
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self._droppedLock:
+                self.nDropped += 1
+
+    def _handle(self, record):
+
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _write(self):
+        """Writes the queued records until it gets None."""
+
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            self._handle(record)
+            self._reportDropped()
+
+    def _reportDropped(self):
+        """Logs the number of records dropped since it was last reported."""
+
+        if self.nDropped == 0:
+            return
+
+        with self._droppedLock:
+            nDropped = self.nDropped
+            self.nDropped = 0
+
+        self._handle(logging.makeLogRecord(
+            {'name': 'logWriter', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+             'msg': 'log queue full: dropped %d records', 'args': (nDropped,)}))
+
+    def close(self):
+
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(10)
+
+        if not self._thread.is_alive():
+            self._reportDropped()
+
+        for handler in self.handlers:
+            handler.flush()
+
+        logging.Handler.close(self)
+
+
+def benchmarkLogging(nRecords=100000, logDir=None, maxSize=10000):
+    """Times logging to a file directly and through a `QueueLogHandler`.
+
+    For each mode, returns the records per second seen by the caller and
+    the records per second until all of them were written. Also times a
+    filtered-out debug call with eager and with lazy formatting.
+
+    """
+
+    logDir = logDir or tempfile.mkdtemp()
+    results = {}
+
+    for mode in ['direct', 'queue']:
+
+        logger = logging.getLogger('benchmark.' + mode)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+
+        fileHandler = logging.FileHandler(os.path.join(logDir, mode + '.log'))
+        fileHandler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s '
+                                                   '%(message)s'))
+        if mode == 'direct':
+            handler = fileHandler
+        else:
+            handler = QueueLogHandler([fileHandler], maxSize=maxSize, block=True)
+        logger.addHandler(handler)
+
+        start = time.time()
+        for ii in range(nRecords):
+            logger.info('new cmd: %s', ii)
+        callTime = time.time() - start
+
+        handler.close()
+        totalTime = time.time() - start
+
+        logger.removeHandler(handler)
+        fileHandler.close()
+
+        results[mode] = {'callRate': nRecords / callTime, 'writeRate': nRecords / totalTime}
+
+    logger = logging.getLogger('benchmark.filtered')
+    logger.setLevel(logging.INFO)
+    cmd = 'guider 1 ping'
+
+    start = time.time()
+    for ii in range(nRecords):
+        logger.debug('raw cmd: %s' % (cmd))
+    results['eagerDebug'] = {'callRate': nRecords / (time.time() - start)}
+
+    start = time.time()
+    for ii in range(nRecords):
+        logger.debug('raw cmd: %s', cmd)
+    results['lazyDebug'] = {'callRate': nRecords / (time.time() - start)}
+
+    return results
+
+
+class _FanoutConnection(object):
+    """The output pending for one connection.
+
+    Takes the place of the transport of the connection, so the connection
+    formats and writes its output as usual. The writes made from any thread
+    during one reactor iteration are joined and written to the transport at
+    once. Anything else is passed through to ``transport``.
+
+    Registers itself as the streaming producer of the transport, so the
+    transport pauses it when its own buffer is full. While paused, the
+    output is kept in a buffer of at most ``maxBytes``; when that
+    overflows, the oldest output is dropped or, with the ``disconnect``
+    policy, the connection is closed.
+
+    """
+
+    def __init__(self, transport, maxBytes, policy='drop'):
+
+        self.transport = transport
+        self.maxBytes = maxBytes
+        self.policy = policy
+
+        self.paused = False
+        self.closed = False
+        self.queue = collections.deque()
+        self.nBytes = 0
+        self.nWritten = 0
+        self.nDropped = 0
+        self.maxLag = 0.
+
+        self._pending = []
+        self._lock = threading.Lock()
+
+        try:
+            transport.registerProducer(self, True)
+        except Exception:
+            # Someone else is producing for this transport; we cannot know
+            # when it is full, so everything is written straight away.
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    @property
+    def lag(self):
+        """Seconds since the oldest broadcast still in the buffer was sent."""
+
+        return time.time() - self.queue[0][0] if self.queue else 0.
+
+    def write(self, data):
+        """Queues output for the next flush. Can be called from any thread."""
+
+        with self._lock:
+            self._pending.append((time.time(), data))
+            if len(self._pending) > 1:
+                return
+
+        reactor.callFromThread(self._flush)
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+    def _flush(self):
+        """Writes the pending output at once. Runs in the reactor thread."""
+
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+
+        if len(pending) == 0:
+            return
+
+        data = b''.join(item[1] for item in pending)
+        self._send(pending[0][0], data, data.count(b'\n'))
+
+    def _send(self, sentTime, data, nLines):
+
+        if self.closed:
+            return
+
+        if not self.paused and not self.queue:
+            self.transport.write(data)
+            self.nWritten += nLines
+            return
+
+        self.queue.append((sentTime, data, nLines))
+        self.nBytes += len(data)
+
+        while self.nBytes > self.maxBytes and self.queue:
+            if self.policy == 'disconnect':
+                self.nDropped += sum(item[2] for item in self.queue)
+                self.stopProducing()
+                getattr(self.transport, 'abortConnection', self.transport.loseConnection)()
+                return
+            sentTime, data, nLines = self.queue.popleft()
+            self.nBytes -= len(data)
+            self.nDropped += nLines
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+
+        self.paused = False
+
+        now = time.time()
+        while self.queue and not self.paused:
+            sentTime, data, nLines = self.queue.popleft()
+            self.nBytes -= len(data)
+            self.maxLag = max(self.maxLag, now - sentTime)
+            self.transport.write(data)
+            self.nWritten += nLines
+
+    def stopProducing(self):
+
+        self.closed = True
+        self.paused = True
+        self.queue.clear()
+        self.nBytes = 0
+
+
+class _BroadcastCounter(object):
+    """Counts the broadcasts sent through a source in a `PerfStats`.
+
+    Takes the place of the source of the broadcast command, so every
+    broadcast is counted whichever method sends it. Anything else is passed
+    through to ``source``.
+
+    """
+
+    def __init__(self, source, perfStats):
+
+        self.source = source
+        self.perfStats = perfStats
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def sendResponse(self, cmd, flag, response):
+
+        self.perfStats.addBroadcast()
+        self.source.sendResponse(cmd, flag, response)
+
+
+class BroadcastFanout(object):
+    """Sends the broadcasts to every connected source, coalesced and bounded.
+
+    Takes the place of the command link manager as the source of the
+    broadcast command. The broadcasts sent from any thread during one
+    reactor iteration are handed to ``linkManager`` together, and each
+    connection formats and writes them through its own send path. The
+    transport of each connection is wrapped in a `_FanoutConnection`, which
+    joins those writes and buffers at most ``maxBytes``, so a stalled client
+    cannot make the actor grow without limit. Anything else is passed
+    through to ``linkManager``.
+
+    """
+
+    def __init__(self, linkManager, maxBytes=1024**2, policy='drop'):
+
+        self.linkManager = linkManager
+        self.maxBytes = maxBytes
+        self.policy = policy
+
+        self.connections = {}
+        self.nFlushes = 0
+        self.nLines = 0
+
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.linkManager, name)
+
+    def sendResponse(self, cmd, flag, response):
+        """Queues a broadcast for the next flush. Can be called from any thread."""
+
+        with self._lock:
+            self._pending.append((cmd, flag, response))
+            if len(self._pending) > 1:
+                return
+
+        reactor.callFromThread(self._flush)
+
+    def _getConnections(self):
+        """Wraps the transport of each new connection, forgetting the closed ones."""
+
+        links = getattr(self.linkManager, 'activeConnections', [])
+
+        for link in list(self.connections):
+            if link not in links:
+                self.connections.pop(link).stopProducing()
+
+        for link in links:
+            if link not in self.connections:
+                connection = _FanoutConnection(link.transport, self.maxBytes,
+                                               policy=self.policy)
+                link.transport = connection
+                self.connections[link] = connection
+
+        return list(self.connections.values())
+
+    def _flush(self):
+        """Sends the pending broadcasts to the connections. Runs in the reactor thread."""
+
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+
+        if len(pending) == 0:
+            return
+
+        self._getConnections()
+        for cmd, flag, response in pending:
+            self.linkManager.sendResponse(cmd, flag, response)
+
+        self.nFlushes += 1
+        self.nLines += len(pending)
+
+    def getKeywords(self):
+        """Returns the fan-out statistics and one keyword per connection, with lags in ms."""
+
+        keywords = ['perfFanout=%d,%d,%d' % (self.nFlushes, self.nLines, len(self.connections))]
+        for ii, connection in enumerate(list(self.connections.values())):
+            keywords.append('perfConnection=%d,%d,%d,%d,%.3f,%.3f,%s' %
+                            (ii, connection.nWritten, connection.nBytes, connection.nDropped,
+                             1e3 * connection.lag, 1e3 * connection.maxLag,
+                             'T' if connection.closed else 'F'))
+
+        return keywords
+
+    def toDict(self):
+        return {'nFlushes': self.nFlushes, 'nLines': self.nLines,
+                'connections': [{'written': connection.nWritten,
+                                 'bufferedBytes': connection.nBytes,
+                                 'dropped': connection.nDropped,
+                                 'lag': connection.lag, 'maxLag': connection.maxLag,
+                                 'closed': connection.closed}
+                                for connection in list(self.connections.values())]}
+
+
+class FakeGuiderCmd(object):
+    """Commands to control the output of the fake guider."""
+
+    def __init__(self, actor):
+
+        self.actor = actor
+        self.keys = keys.KeysDictionary(
+            'fakeGuider_fakeGuider', (1, 1),
+            keys.Key('cadence', types.Float(), help='Seconds between broadcasts.'),
+            keys.Key('msgRate', types.Float(),
+                     help='Messages per second of the synthetic keyword stream.'),
+            keys.Key('logFile', types.String(), help='The log to replay.'),
+            keys.Key('speed', types.Float(),
+                     help='How many times faster than recorded to replay; 0 is as fast as possible.'),
+            keys.Key('dumpFile', types.String(),
+                     help='A JSON file in which to write the performance statistics.'))
+        self.vocab = [
+            ('broadcast', '@(start|stop|rate|status) [<cadence>]', self.broadcast),
+            ('stream', '@(start|stop|status) [<msgRate>]', self.stream),
+            ('replay', '@(start|stop|status) [<logFile>] [<speed>]', self.replay),
+            ('matchCache', '@(status|clear)', self.matchCache),
+            ('perfStatus', '[<dumpFile>] [reset]', self.perfStatus),
+        ]
+
+    def broadcast(self, cmd):
+        """Starts, stops or changes the cadence of the fake guider broadcasts."""
+
+        keywords = cmd.cmd.keywords
+        scheduler = self.actor.broadcastScheduler
+
+        cadence = keywords['cadence'].values[0] if 'cadence' in keywords else None
+        if cadence is not None and float(cadence) <= 0:
+            cmd.fail('text="cadence must be positive"')
+            return
+
+        if 'start' in keywords:
+            scheduler.start(cadence=cadence)
+            running = True
+        elif 'stop' in keywords:
+            scheduler.stop()
+            running = False
+        elif 'rate' in keywords:
+            if cadence is None:
+                cmd.fail('text="rate requires a cadence"')
+                return
+            scheduler.setCadence(cadence)
+            running = scheduler.running
+        else:
+            running = scheduler.running
+
+        cmd.finish('broadcastState=%s; broadcastCadence=%g' %
+                   ('on' if running else 'off', scheduler.cadence))
+
+    def stream(self, cmd):
+        """Starts or stops the high-rate synthetic guider keyword stream."""
+
+        keywords = cmd.cmd.keywords
+        stream = self.actor.keywordStream
+
+        msgRate = keywords['msgRate'].values[0] if 'msgRate' in keywords else None
+        if msgRate is not None and float(msgRate) <= 0:
+            cmd.fail('text="msgRate must be positive"')
+            return
+
+        if 'start' in keywords:
+            stream.start(rate=msgRate)
+            running = True
+        elif 'stop' in keywords:
+            stream.stop()
+            running = False
+        else:
+            running = stream.running
+
+        cmd.finish('streamState=%s; streamRate=%g; streamSent=%d' %
+                   ('on' if running else 'off', stream.rate, stream.nSent))
+
+    def perfStatus(self, cmd):
+        """Reports the performance statistics, optionally writing them to a JSON file."""
+
+        keywords = cmd.cmd.keywords
+        perfStats = self.actor.perfStats
+
+        for keyword in perfStats.getKeywords():
+            cmd.inform(keyword)
+
+        if 'dumpFile' in keywords:
+            dumpFile = keywords['dumpFile'].values[0]
+            perfStats.dump(dumpFile)
+            cmd.inform('text=%s' % (qstr('wrote %s' % (dumpFile))))
+
+        if 'reset' in keywords:
+            perfStats.reset()
+
+        cmd.finish('')
+
+    def matchCache(self, cmd):
+        """Reports on, or clears, the cache of matched commands."""
+
+        matchCache = self.actor.matchCache
+        if 'clear' in cmd.cmd.keywords:
+            matchCache.clear()
+
+        cmd.finish('matchCache=%d,%d,%d,%d' % (matchCache.hits, matchCache.misses,
+                                               len(matchCache), matchCache.maxSize))
+
+    def replay(self, cmd):
+        """Replays the replies recorded in an actor or hub log."""
+
+        keywords = cmd.cmd.keywords
+        replay = self.actor.keywordReplay
+
+        speed = keywords['speed'].values[0] if 'speed' in keywords else None
+        if speed is not None and float(speed) < 0:
+            cmd.fail('text="speed cannot be negative"')
+            return
+
+        if 'start' in keywords:
+            logFile = (keywords['logFile'].values[0] if 'logFile' in keywords
+                       else self.actor.getConfig('replayLog'))
+            if not logFile or not os.path.exists(logFile):
+                cmd.fail('text=%s' % (qstr('log file %s not found' % (logFile))))
+                return
+            replay.start(logFile, speed=speed)
+            running = True
+        elif 'stop' in keywords:
+            replay.stop()
+            running = False
+        else:
+            running = replay.running
+
+        cmd.finish('replayState=%s; replayFile=%s; replaySpeed=%g; replaySent=%d' %
+                   ('on' if running else 'off', qstr(replay.path or ''),
+                    replay.speed if speed is None else float(speed), replay.nSent))
+
+
+def serveCommands(commandQueue):
+    """Runs commands from a queue until it gets None. Runs in each worker thread.
+
+    Each item in the queue is an actor and one of its commands, so several
+    actors can share the workers.
+
+    """
+
+    while True:
+        item = commandQueue.get()
+        if item is None:
+            return
+
+        actor, cmd = item
+        verb = actor.getVerb(cmd)
+        limitKeys = actor.limiter.getKeys(verb, actor.verbCmdSets.get(verb))
+        if limitKeys and not actor.limiter.acquire(limitKeys, cmd):
+            continue
+
+        # Run the command and then any held command that it freed a slot for.
+        while cmd is not None:
+            try:
+                actor.runActorCmd(cmd)
+            finally:
+                released = actor.limiter.release(limitKeys) if limitKeys else None
+
+            limitKeys, cmd = released if released else (None, None)
+
+
+def startWorkers(commandQueue, nWorkers, name):
+    """Starts ``nWorkers`` threads serving a command queue and returns them."""
+
+    workers = []
+    for ii in range(nWorkers):
+        worker = threading.Thread(target=serveCommands, args=(commandQueue,),
+                                  name='%s-worker-%d' % (name, ii))
+        worker.start()
+        workers.append(worker)
+
+    return workers
+
+
 class FakeGuider(object):
 
-    def __init__(self, name, productName='guiderActor', makeCmdrConnection=True):
+    def __init__(self, name, productName='guiderActor', makeCmdrConnection=True,
+                 config=None, commandQueue=None, ownsRootLogger=True):
+        """ A fake actor.
+
+        Several actors can share a config, with a section per actor name, and a
+        commandQueue served by a common pool of workers (see FakeActorHost). Only
+        one of them should own the root logger (ownsRootLogger).
+        """
+
+        self.initTime = time.time()
         self.ii = 1026
         self.name = name
         self.productName = productName if productName else self.name
@@ -50,19 +1526,39 @@ class FakeGuider(object):
 
         self.parser = CommandParser()
 
-        self.config = ConfigParser.ConfigParser()
-        self.config.read(os.path.join(os.path.dirname(__file__), 'guider.cfg'))
+        if config is None:
+            config = ConfigParser.ConfigParser()
+            config.read(os.path.join(os.path.dirname(__file__), 'guider.cfg'))
+        self.config = config
 
+        self.ownsRootLogger = ownsRootLogger
         self.configureLogs()
 
-        # The list of all connected sources.
-        tronInterface = ''
-        tronPort = 9994
+        # The list of all connected sources. Our section can override the port.
+        tronInterface = self.getConfig('interface', self.config.get('tron', 'interface'))
+        tronPort = int(self.getConfig('port', self.config.get('tron', 'port')))
         self.commandSources = cmdLinkManager.listen(self,
                                                     port=tronPort,
                                                     interface=tronInterface)
-        # The Command which we send uncommanded output to.
-        self.bcast = actorCmd.Command(self.commandSources,
+        # The Command which we send uncommanded output to. Its output can be
+        # coalesced and buffered per connection by a BroadcastFanout.
+        if self.getConfig('coalesceBroadcasts', True, 'getboolean'):
+            self.broadcastFanout = BroadcastFanout(
+                self.commandSources,
+                maxBytes=self.getConfig('fanoutBuffer', 1024**2, 'getint'),
+                policy=self.getConfig('fanoutPolicy', 'drop'))
+            bcastSource = self.broadcastFanout
+        else:
+            self.broadcastFanout = None
+            bcastSource = self.commandSources
+
+        # The queue is shared with other actors if we are run by a host.
+        self.ownsCommandQueue = commandQueue is None
+        self.commandQueue = Queue.Queue() if commandQueue is None else commandQueue
+        self.shuttingDown = False
+
+        self.perfStats = PerfStats(self.commandQueue, fanout=self.broadcastFanout)
+        self.bcast = actorCmd.Command(_BroadcastCounter(bcastSource, self.perfStats),
                                       'self.0', 0, 0, None, immortal=True)
 
         # IDs to send commands to ourself.
@@ -77,10 +1573,81 @@ class FakeGuider(object):
 
         self.handler = validation.CommandHandler()
 
-        self.attachAllCmdSets()
+        # The command set of each verb, and the limits on how many commands of
+        # each verb or command set can run at once.
+        self.verbCmdSets = {}
+        self.limiter = ConcurrencyLimiter(
+            {'verb': _parseLimits(self.getConfig('verbConcurrency')),
+             'cmdSet': _parseLimits(self.getConfig('cmdSetConcurrency'))})
+        self.dedicatedVerbs = set(verb.strip() for verb in
+                                  self.getConfig('dedicatedVerbs', '').split(',')
+                                  if verb.strip())
+        self.nWorkers = self.getConfig('workerThreads', 4, 'getint')
+        self.workers = []
+
+        # Load tests repeat the same commands, which need only be matched once.
+        self.matchCache = MatchCache(self.getConfig('matchCacheSize', 256, 'getint'))
+
+        # Serializes changes to the command handler with matching against it.
+        self._handlerLock = threading.RLock()
+
+        # Command sets whose verbs are known from the manifest but which are
+        # only imported the first time one of their verbs is used. Maps each
+        # verb to the list of (cname, path) of the deferred sets that have it.
+        self.lazyCmdSets = {}
+        self._lazyLock = threading.RLock()
+        self.cmdSetManifestFile = os.path.expanduser(
+            self.getConfig('cmdSetManifest', '~/.fake_guider_cmdsets.json'))
+        self.cmdSetManifest = self.readCmdSetManifest()
+
+        attachStart = time.time()
+        self.attachAllCmdSets(lazy=self.getConfig('lazyCmdSets', True, 'getboolean'))
+        self.attachCmdSetObject('FakeGuiderCmd', FakeGuiderCmd(self))
+        deferred = sorted(set(cname for lazySets in self.lazyCmdSets.values()
+                              for cname, path in lazySets))
+        self.logger.info('attached command sets in %.3f s (%d deferred: %s)' %
+                         (time.time() - attachStart, len(deferred), deferred))
+
+        # A single scheduler sends all the uncommanded output, no matter how
+        # many commands we receive.
+        self.broadcastScheduler = BroadcastScheduler(
+            self.output_file, self.getConfig('broadcastCadence', 10., 'getfloat'),
+            logger=self.logger)
+
+        # The synthetic keyword stream, for load-testing whoever listens to us.
+        self.keywordStream = KeywordStream(
+            functools.partial(self.sendReply, 'i'),
+            rate=self.getConfig('streamRate', 100., 'getfloat'),
+            tick=self.getConfig('streamTick', 0.05, 'getfloat'),
+            nFrames=self.getConfig('streamFrames', 256, 'getint'),
+            logger=self.logger)
+
+        # Replays recorded logs.
+        replayPattern = self.getConfig('replayPattern')
+        self.keywordReplay = KeywordReplay(
+            self.sendReply,
+            speed=self.getConfig('replaySpeed', 1., 'getfloat'),
+            batchSize=self.getConfig('replayBatch', 1000, 'getint'),
+            pattern=re.compile(replayPattern) if replayPattern else replayRe,
+            actor=self.getConfig('replayActor', self.name),
+            logger=self.logger)
+
+        # Writes the frames we announce, if asked to.
+        self.gimgDir = self.getConfig('gimgDir', '/data/gcam')
+        if self.getConfig('writeFrames', False, 'getboolean'):
+            self.gimgWriter = ProcGimgWriter(
+                self.gimgDir,
+                size=self.getConfig('gimgSize', 1024, 'getint'),
+                nBuffers=self.getConfig('gimgBuffers', 4, 'getint'),
+                nThreads=self.getConfig('gimgThreads', 2, 'getint'),
+                compressLevel=self.getConfig('gimgCompressLevel', 1, 'getint'),
+                logger=self.logger)
+        else:
+            self.gimgWriter = None
 
-        self.commandQueue = Queue.Queue()
-        self.shuttingDown = False
+        self.perfStatusScheduler = BroadcastScheduler(
+            self.sendPerfStatus, self.getConfig('perfCadence', 0., 'getfloat') or 10.,
+            logger=self.logger)
 
         if makeCmdrConnection:
             self.cmdr = actorcore.CmdrConnection.Cmdr(name, self)
@@ -89,15 +1656,45 @@ class FakeGuider(object):
         else:
             self.cmdr = None
 
-    def configureLogs(self, cmd=None):
-        """ (re-)configure our logs. """
+    def getConfig(self, option, default=None, getter='get'):
+        """ Return an option from our section of the configuration, or a default. """
 
-        self.logDir = self.config.get('logging', 'logdir')
-        assert self.logDir, "logdir must be set!"
+        try:
+            return getattr(self.config, getter)(self.name, option)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return default
+
+    def configureRootLogger(self):
+        """ Set up the root logger, writing through a queue if configured. """
+
+        # Stop writing through the previous queue, if we are reconfiguring.
+        if getattr(self, 'logQueueHandler', None):
+            logging.getLogger('').removeHandler(self.logQueueHandler)
+            self.logQueueHandler.close()
+            self.logQueueHandler = None
 
         # Make the root logger go to a rotating file. All others derive from this.
         setupRootLogger(self.logDir)
 
+        # The root handlers are moved behind a queue, so that whoever logs
+        # never waits for the disk.
+        try:
+            logQueueSize = int(self.config.get('logging', 'queueSize'))
+        except:
+            logQueueSize = 0
+        if logQueueSize > 0:
+            try:
+                logBlock = self.config.get('logging', 'queueFullPolicy') == 'block'
+            except:
+                logBlock = False
+            rootLogger = logging.getLogger('')
+            rootHandlers = list(rootLogger.handlers)
+            self.logQueueHandler = QueueLogHandler(rootHandlers, maxSize=logQueueSize,
+                                                   block=logBlock)
+            for handler in rootHandlers:
+                rootLogger.removeHandler(handler)
+            rootLogger.addHandler(self.logQueueHandler)
+
         # The real stderr/console filtering is actually done through the console Handler.
         try:
             consoleLevel = int(self.config.get('logging', 'consoleLevel'))
@@ -105,6 +1702,16 @@ class FakeGuider(object):
             consoleLevel = int(self.config.get('logging', 'baseLevel'))
         setConsoleLevel(consoleLevel)
 
+    def configureLogs(self, cmd=None):
+        """ (re-)configure our logs. """
+
+        self.logDir = self.config.get('logging', 'logdir')
+        assert self.logDir, "logdir must be set!"
+
+        # When several actors share the process, only one of them sets up the root logger.
+        if self.ownsRootLogger:
+            self.configureRootLogger()
+
         # self.console needs to be renamed ore deleted, I think.
         self.console = logging.getLogger('')
         self.console.setLevel(int(self.config.get('logging', 'baseLevel')))
@@ -186,7 +1793,10 @@ class FakeGuider(object):
                 file.close()
 
         # Instantiate and save a new command handler.
-        cmdSet = getattr(mod, cname)(self)
+        self.attachCmdSetObject(cname, getattr(mod, cname)(self))
+
+    def attachCmdSetObject(self, cname, cmdSet):
+        """ Attach an instantiated set of commands, replacing any set with the same name. """
 
         # Check any new commands before finishing with the load. This
         # is a bit messy, as the commands might depend on a valid
@@ -199,6 +1809,7 @@ class FakeGuider(object):
         if hasattr(cmdSet, 'keys') and cmdSet.keys:
             keys.CmdKey.addKeys(cmdSet.keys)
         valCmds = []
+        verbs = []
         for v in cmdSet.vocab:
             try:
                 verb, args, func = v
@@ -210,26 +1821,87 @@ class FakeGuider(object):
             funcDoc = inspect.getdoc(func)
             valCmd = validation.Cmd(verb, args, help=funcDoc) >> func
             valCmds.append(valCmd)
+            verbs.append(verb)
+
+        with self._handlerLock:
+            # Got this far? Commit. Save the Cmds so that we can delete them later.
+            oldCmdSet = self.commandSets.get(cname, None)
+            cmdSet.validatedCmds = valCmds
+            self.commandSets[cname] = cmdSet
+
+            for verb, verbCmdSet in list(self.verbCmdSets.items()):
+                if verbCmdSet == cname:
+                    del self.verbCmdSets[verb]
+            for verb in verbs:
+                self.verbCmdSets[verb] = cname
+
+            # Delete previous set of consumers for this named CmdSet, add new ones.
+            if oldCmdSet:
+                self.handler.removeConsumers(*oldCmdSet.validatedCmds)
+            self.handler.addConsumers(*cmdSet.validatedCmds)
+            self.matchCache.clear()
+
+        # Once attached, the set must not be imported again when one of its
+        # verbs is first used.
+        with self._lazyLock:
+            for verb, lazySets in list(self.lazyCmdSets.items()):
+                lazySets = [lazySet for lazySet in lazySets if lazySet[0] != cname]
+                if lazySets:
+                    self.lazyCmdSets[verb] = lazySets
+                else:
+                    del self.lazyCmdSets[verb]
 
-        # Got this far? Commit. Save the Cmds so that we can delete them later.
-        oldCmdSet = self.commandSets.get(cname, None)
-        cmdSet.validatedCmds = valCmds
-        self.commandSets[cname] = cmdSet
+        self.logger.debug("handler verbs: %s", list(self.handler.consumers.keys()))
 
-        # Delete previous set of consumers for this named CmdSet, add new ones.
-        if oldCmdSet:
-            self.handler.removeConsumers(*oldCmdSet.validatedCmds)
-        self.handler.addConsumers(*cmdSet.validatedCmds)
+    def readCmdSetManifest(self):
+        """ Return the cached manifest of command set files and their verbs. """
 
-        self.logger.debug("handler verbs: %s" % (self.handler.consumers.keys()))
+        try:
+            with open(self.cmdSetManifestFile) as unit:
+                return json.load(unit)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def writeCmdSetManifest(self):
+        """ Save the manifest of command set files, if it can be written. """
 
-    def attachAllCmdSets(self, path=None):
+        try:
+            tmpFile = self.cmdSetManifestFile + '.tmp'
+            with open(tmpFile, 'w') as unit:
+                json.dump(self.cmdSetManifest, unit, indent=1, sort_keys=True)
+            os.rename(tmpFile, self.cmdSetManifestFile)
+        except (IOError, OSError) as e:
+            self.logger.warn('cannot write the command set manifest: %s' % (e))
+
+    def attachLazyCmdSet(self, verb):
+        """ Import and attach all the deferred command sets that have a verb. """
+
+        with self._lazyLock:
+            lazySets = list(self.lazyCmdSets.get(verb, []))
+            if not lazySets:
+                return
+
+            # Attaching a set removes its entries from lazyCmdSets.
+            loadStart = time.time()
+            for cname, path in lazySets:
+                self.attachCmdSet(cname, [path])
+
+        self.logger.info('attached deferred command sets %s in %.3f s' %
+                         (', '.join(cname for cname, path in lazySets),
+                          time.time() - loadStart))
+
+    def attachAllCmdSets(self, path=None, lazy=False):
         """ (Re-)load all command classes -- files in ./Command which end with Cmd.py.
+
+        If lazy, the command sets that have not changed since they were
+        recorded in the manifest are not imported; their verbs are registered
+        and the set is attached the first time one of them is used.
         """
 
         if path is None:
             self.attachAllCmdSets(path=os.path.join(os.path.expandvars('$ACTORCORE_DIR'),
-                                                    'python', 'actorcore', 'Commands'))
+                                                    'python', 'actorcore', 'Commands'),
+                                  lazy=lazy)
             # self.attachAllCmdSets(path=os.path.join(self.product_dir, 'python', self.productName,
             #                                         'Commands'))
             return
@@ -238,11 +1910,35 @@ class FakeGuider(object):
         dirlist.sort()
         self.logger.info("loading %s" % (dirlist))
 
+        manifestChanged = False
+
         for f in dirlist:
             if os.path.isdir(f) and not f.startswith('.'):
-                self.attachAllCmdSets(path=f)
+                self.attachAllCmdSets(path=f, lazy=lazy)
             if re.match('^[a-zA-Z][a-zA-Z0-9_-]*Cmd\.py$', f):
-                self.attachCmdSet(f[:-3], [path])
+                cname = f[:-3]
+                filename = os.path.abspath(os.path.join(path, f))
+                stat = os.stat(filename)
+                entry = self.cmdSetManifest.get(filename)
+
+                if (lazy and entry and entry['mtime'] == stat.st_mtime and
+                        entry['size'] == stat.st_size and cname not in self.commandSets):
+                    with self._lazyLock:
+                        for verb in entry['verbs']:
+                            lazySets = self.lazyCmdSets.setdefault(verb, [])
+                            if (cname, path) not in lazySets:
+                                lazySets.append((cname, path))
+                            self.verbCmdSets[verb] = cname
+                    continue
+
+                self.attachCmdSet(cname, [path])
+                self.cmdSetManifest[filename] = {
+                    'mtime': stat.st_mtime, 'size': stat.st_size,
+                    'verbs': sorted(set(v[0] for v in self.commandSets[cname].vocab))}
+                manifestChanged = True
+
+        if manifestChanged:
+            self.writeCmdSetManifest()
 
     def cmdTraceback(self, e):
         eType, eValue, eTraceback = sys.exc_info()
@@ -253,14 +1949,30 @@ class FakeGuider(object):
 
     def runActorCmd(self, cmd):
 
-        self.output_file()
+        started = time.time()
 
         try:
             cmdStr = cmd.rawCmd
-            self.cmdLog.debug('raw cmd: %s' % (cmdStr))
+            verb = self.getVerb(cmd)
+            self.cmdLog.debug('raw cmd: %s', cmdStr)
+
+            # Attaching takes the handler lock, so no worker matches against
+            # a half-attached command set.
+            if self.lazyCmdSets and verb in self.lazyCmdSets:
+                try:
+                    self.attachLazyCmdSet(verb)
+                except Exception as e:
+                    cmd.fail('text=%s' % (qstr("Loading the commands for %s failed: %s" %
+                                               (cmdStr, e))))
+                    return
 
             try:
-                validatedCmd, cmdFuncs = self.handler.match(cmdStr)
+                match, generation = self.matchCache.get(cmdStr)
+                if match is None:
+                    with self._handlerLock:
+                        match = self.handler.match(cmdStr)
+                    self.matchCache.put(cmdStr, match, generation)
+                validatedCmd, cmdFuncs = match
             except Exception as e:
                 cmd.fail('text=%s' % (qstr("Unmatched command: %s (exception: %s)" %
                                            (cmdStr, e))))
@@ -271,7 +1983,7 @@ class FakeGuider(object):
                 cmd.fail('text=%s' % (qstr("Unrecognized command: %s" % (cmdStr))))
                 return
 
-            self.cmdLog.info('< %s:%d %s' % (cmd.cmdr, cmd.mid, validatedCmd))
+            self.cmdLog.info('< %s:%d %s', cmd.cmdr, cmd.mid, validatedCmd)
             if len(cmdFuncs) > 1:
                 cmd.warn('text=%s' % (qstr("command has more than one callback (%s): %s" %
                                            (cmdFuncs, validatedCmd))))
@@ -284,6 +1996,10 @@ class FakeGuider(object):
                 cmd.fail('text=%s' % (qstr("command failed: %s" % (oneLiner))))
                 # tback('newCmd', e)
                 return
+            finally:
+                self.perfStats.addCommand(verb,
+                                          getattr(cmd, 'perfQueued', started),
+                                          started, time.time())
 
         except Exception as e:
             cmd.fail('text=%s' %
@@ -294,18 +2010,16 @@ class FakeGuider(object):
             except:
                 pass
 
+    def getVerb(self, cmd):
+        """ Return the verb of a command, or '' if the command is blank. """
+
+        words = cmd.rawCmd.split(None, 1)
+        return words[0] if words else ''
+
     def actor_loop(self):
-        """ Check the command queue and dispatch commands."""
+        """ Check the command queue and dispatch commands. Runs in each worker. """
 
-        while True:
-            try:
-                cmd = self.commandQueue.get(block=True, timeout=3)
-            except Queue.Empty:
-                if self.shuttingDown:
-                    return
-                else:
-                    continue
-            self.runActorCmd(cmd)
+        serveCommands(self.commandQueue)
 
     def commandFailed(self, cmd):
         """ Gets called when a command has failed. """
@@ -314,17 +2028,27 @@ class FakeGuider(object):
     def newCmd(self, cmd):
         """ Dispatch a newly received command. """
 
-        self.cmdLog.info('new cmd: %s' % (cmd))
+        self.cmdLog.info('new cmd: %s', cmd)
 
-        # Empty cmds are OK; send an empty response...
-        if len(cmd.rawCmd) == 0:
+        verb = self.getVerb(cmd)
+
+        # Empty or blank cmds are OK; send an empty response...
+        if not verb:
             cmd.finish('')
             return None
 
+        self.perfStats.queued(cmd)
+
         if self.runInReactorThread:
             self.runActorCmd(cmd)
+        elif verb in self.dedicatedVerbs:
+            worker = threading.Thread(target=self.runActorCmd, args=(cmd,),
+                                      name='%s-%s' % (self.name, verb))
+            worker.daemon = True
+            worker.start()
         else:
-            self.commandQueue.put(cmd)
+            self.commandQueue.put((self, cmd))
+            self.perfStats.sampleQueueDepth()
 
         return self
 
@@ -336,9 +2060,24 @@ class FakeGuider(object):
         self.synthMID += 1
         self.newCmd(cmd)
 
+    def _ready(self):
+        """ Called by the reactor once it runs, when we can take commands. """
+
+        self.startupTime = time.time() - self.initTime
+        self.perfStats.startupTime = self.startupTime
+        self.logger.info('ready in %.3f s' % (self.startupTime))
+
     def _shutdown(self):
         self.shuttingDown = True
 
+        # Wake up each worker, which exits once the commands before it are done.
+        for worker in self.workers:
+            self.commandQueue.put(None)
+
+        perfDumpFile = self.getConfig('perfDumpFile')
+        if perfDumpFile:
+            self.perfStats.dump(perfDumpFile)
+
     def run(self, doReactor=True):
         """ Actually run the twisted reactor. """
         try:
@@ -346,10 +2085,19 @@ class FakeGuider(object):
         except:
             self.runInReactorThread = False
 
+        if self.getConfig('broadcastOnStart', True, 'getboolean'):
+            self.broadcastScheduler.start()
+        if self.getConfig('streamOnStart', False, 'getboolean'):
+            self.keywordStream.start()
+        if self.getConfig('perfCadence', 0., 'getfloat') > 0:
+            self.perfStatusScheduler.start(now=False)
+
+        reactor.callWhenRunning(self._ready)
+
         self.logger.info("starting reactor (in own thread=%s)...." % (not self.runInReactorThread))
         try:
-            if not self.runInReactorThread:
-                threading.Thread(target=self.actor_loop).start()
+            if not self.runInReactorThread and self.ownsCommandQueue:
+                self.workers = startWorkers(self.commandQueue, self.nWorkers, self.name)
             if doReactor:
                 reactor.run()
         except Exception as e:
@@ -359,13 +2107,148 @@ class FakeGuider(object):
             self.logger.info("reactor dead, cleaning up...")
             self._shutdown()
 
+    def sendReply(self, flag, keywords):
+        """ Broadcast keywords with an inform (i), warning (w) or debug (d) flag. """
+
+        if flag == 'w':
+            self.bcast.warn(keywords)
+        elif flag == 'd':
+            self.bcast.diag(keywords)
+        else:
+            self.bcast.inform(keywords)
+
+    def sendPerfStatus(self):
+        """ Broadcast the performance statistics. Called periodically if perfCadence is set. """
+
+        for keyword in self.perfStats.getKeywords():
+            self.bcast.inform(keyword)
+
+    def announceFile(self, path):
+        """ Broadcast the file keyword for a frame directory and file name. """
+
+        dirname, filename = path
+        self.sendReply('i', 'file=%s/,%s' % (dirname, filename))
+
     def output_file(self):
-        self.bcast.inform('guideState="on"')
-        self.bcast.inform('file=/data/gcam/57831/,proc-gimg-{0}.fits.gz'.format(self.ii))
+        """ Broadcast the guide state and a new file. Called by the broadcast scheduler.
+
+        If we write the frames, the file keyword is only sent once the frame is on disk.
+        """
+
+        frameNumber = self.ii
         self.ii += 1
-        reactor.callLater(10, self.output_file)
+
+        self.sendReply('i', 'guideState="on"')
+
+        if self.gimgWriter is None:
+            self.announceFile(getGimgPath(self.gimgDir, frameNumber))
+            return
+
+        deferred = self.gimgWriter.write(frameNumber)
+        if deferred is None:
+            self.logger.warn('dropped proc-gimg frame %d: too many frames pending' %
+                             (frameNumber))
+            return
+
+        deferred.addCallbacks(self.announceFile, lambda failure: None)
+
+
+# The classes of fake actors that FakeActorHost can run, by the name used in
+# the actorClass option. There is only a fake guider for now.
+actorClasses = {'FakeGuider': FakeGuider}
+
+
+class FakeActorHost(object):
+    """Runs several fake actors in one process and reactor.
+
+    The actors are listed in the ``actors`` option of the ``[host]`` section
+    of the configuration. Each one reads its own options, notably its
+    ``port``, ``productName`` and ``actorClass`` (one of ``actorClasses``),
+    from the section with its name, and they all share the ``[tron]`` and
+    ``[logging]`` sections. Their commands are run by a common pool of
+    ``workerThreads`` workers.
+
+    """
+
+    def __init__(self, config):
+
+        self.config = config
+
+        names = [name.strip() for name in self._get('actors', 'guider').split(',')
+                 if name.strip()]
+        self.nWorkers = int(self._get('workerThreads', 8))
+        makeCmdrConnection = self._get('makeCmdrConnection', 'True').lower() in ['true', '1',
+                                                                                'yes', 'on']
+
+        self.commandQueue = Queue.Queue()
+        self.workers = []
+
+        self.actors = []
+        for ii, name in enumerate(names):
+            actorClass = self._get('actorClass', 'FakeGuider', section=name)
+            if actorClass not in actorClasses:
+                raise ValueError('unknown actorClass %s for %s; known classes are %s' %
+                                 (actorClass, name, ', '.join(sorted(actorClasses))))
+            productName = self._get('productName', 'guiderActor', section=name)
+            self.actors.append(actorClasses[actorClass](name, productName=productName,
+                                                        makeCmdrConnection=makeCmdrConnection,
+                                                        config=self.config,
+                                                        commandQueue=self.commandQueue,
+                                                        ownsRootLogger=(ii == 0)))
+
+    def _get(self, option, default, section='host'):
+        try:
+            return self.config.get(section, option)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return default
+
+    def run(self):
+        """Runs the reactor for all the actors."""
+
+        for actor in self.actors:
+            actor.run(doReactor=False)
+
+        self.workers = startWorkers(self.commandQueue, self.nWorkers, 'host')
+
+        logging.getLogger('actor').info('hosting %d actors: %s' %
+                                        (len(self.actors),
+                                         ', '.join(actor.name for actor in self.actors)))
+        try:
+            reactor.run()
+        except Exception as e:
+            tback('run', e)
+
+        for actor in self.actors:
+            actor._shutdown()
+        for worker in self.workers:
+            self.commandQueue.put(None)
 
 
 if __name__ == '__main__':
-    guider = FakeGuider('guider')
-    guider.run()
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]))
+
+    parser.add_argument('--config', '-c', metavar='CONFIG', type=str, default=None,
+                        help='The configuration file. Defaults to guider.cfg.')
+    parser.add_argument('--host', action='store_true', default=False,
+                        help='Run all the actors in the [host] section of the '
+                             'configuration in this process.')
+    parser.add_argument('--benchmark-logging', dest='benchmarkLogging', metavar='N',
+                        type=int, default=None,
+                        help='Time N log records written directly and through the '
+                             'logging queue, and exit.')
+
+    args = parser.parse_args()
+
+    if args.benchmarkLogging is not None:
+        print(json.dumps(benchmarkLogging(args.benchmarkLogging), indent=2, sort_keys=True))
+        sys.exit(0)
+
+    config = ConfigParser.ConfigParser()
+    config.read(args.config or os.path.join(os.path.dirname(__file__), 'guider.cfg'))
+
+    if args.host:
+        FakeActorHost(config).run()
+    else:
+        guider = FakeGuider('guider', config=config)
+        guider.run()
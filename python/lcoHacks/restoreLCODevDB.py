@@ -10,90 +10,718 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import argparse
+import contextlib
+import hashlib
+import json
 import subprocess
 import os
-
-from sdss.internal.database.connections import LCODatabaseDevAdminLocalConnection as db
+import re
+import sys
+import tempfile
+import time
 
 
 apodb_path = '/data/apodb'
 platedb_file = 'platedb_for_dev.sql'
 catalogdb_file = 'catalogdb_for_dev.sql'
 
+# The template database used in snapshot mode, and the file in which we
+# keep the fingerprint of the dumps it was built from.
+template_db = 'lcodb_dev_template'
+template_state_file = os.path.expanduser('~/.lcodb_dev_template.json')
 
-def restoreLCODevDB():
-    """Restores lcodb_dev from a file and modifies it."""
+# A line of a pg_restore TOC list: dump id, catalog and object OIDs, and the
+# description of the entry. With -v, each entry may be followed by a line
+# with the dump ids of the entries it depends on.
+toc_line_re = re.compile(r'^(?P<dumpId>\d+); \d+ \d+ (?P<entry>.+)$')
+toc_depends_re = re.compile(r'^;\s*depends on:(?P<dumpIds>( \d+)*)\s*$')
 
-    # First we drop lcodb_dev
-    print('Dropping lcodb_dev ... ')
-    dropdb = subprocess.Popen('dropdb -U postgres lcodb_dev', shell=True)
-    dropdb.communicate()
+# Entries that create a table. Their tag is always the table name.
+toc_table_types = ['TABLE', 'TABLE DATA']
 
-    # Recreates the DB
-    print('Creating lcodb_dev ... ')
-    createdb = subprocess.Popen('createdb -T template0 -U postgres lcodb_dev',
-                                shell=True)
-    createdb.communicate()
+# When an entry of one of these types is removed, the entries of the
+# associated types it depends on are removed too: the sequence owned by a
+# table, and a view whose rule had to be dumped separately.
+toc_owned_types = {'SEQUENCE OWNED BY': ['SEQUENCE'], 'RULE': ['VIEW']}
 
-    # Restores platedb and catalogdb
-    for file in [platedb_file, catalogdb_file]:
-        schema = file.split('_')[0]
-        print('Restoring {0} ... '.format(schema))
-        path = os.path.join(apodb_path, file)
-        restoreSchema = subprocess.Popen(
-            'pg_restore -d lcodb_dev -Fc -U sdssdb_admin {0}'.format(path),
-            shell=True)
-        restoreSchema.communicate()
+# If set, the metrics of each phase are appended to this file as JSON lines.
+metrics_file = None
+
+# If True, nothing is modified and each phase reports what it would do.
+dry_run = False
+
+
+def recordMetrics(metrics):
+    """Appends the metrics of a phase to ``metrics_file``."""
+
+    if metrics_file is None:
+        return
+
+    with open(metrics_file, 'a') as unit:
+        unit.write(json.dumps(metrics, sort_keys=True) + '\n')
+
+
+@contextlib.contextmanager
+def timed(message, **metrics):
+    """Prints ``message`` and records the wall-clock time the block took.
+
+    Yields a dictionary of metrics for the phase, to which the block can
+    add values such as ``rows`` or ``bytes``. When the block finishes, the
+    metrics are written to ``metrics_file``.
+
+    """
+
+    print('{0} ... '.format(message))
+
+    metrics.update(phase=message, start=time.time(), dry_run=dry_run)
+    yield metrics
+    metrics['wall_time'] = time.time() - metrics['start']
+
+    print('{0} took {1:.1f} s.'.format(message, metrics['wall_time']))
+    recordMetrics(metrics)
+
+
+def runCommand(command, ignoreErrors=False):
+    """Runs a command and waits for it. Raises if the command fails.
+
+    In dry-run mode the command is only printed.
+
+    """
+
+    if dry_run:
+        print('Would run: {0}'.format(' '.join(command)))
+        return
+
+    process = subprocess.Popen(command)
+    process.communicate()
+
+    checkReturnCode(command, process.returncode, ignoreErrors=ignoreErrors)
+
+
+def checkReturnCode(command, returncode, ignoreErrors=False):
+    """Raises a `RuntimeError` if ``returncode`` is not zero."""
+
+    if returncode == 0:
+        return
+
+    message = '{0!r} failed with exit status {1}'.format(' '.join(command),
+                                                        returncode)
+    if ignoreErrors:
+        print('WARNING: ' + message, file=sys.stderr)
+    else:
+        raise RuntimeError(message)
+
+
+def runSQL(sql):
+    """Runs a SQL statement in lcodb_dev with psql.
+
+    Returns the command status printed by psql (e.g., ``DELETE 10``). In
+    dry-run mode the statement is only printed and ``None`` is returned.
+
+    """
+
+    command = ['psql', '-U', 'sdssdb_admin', '-d', 'lcodb_dev',
+               '-v', 'ON_ERROR_STOP=1', '-c', sql]
+
+    if dry_run:
+        print('Would run: {0}'.format(' '.join(command)))
+        return None
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+
+    checkReturnCode(command, process.returncode)
+
+    return output.decode().strip()
+
+
+def querySQL(sql):
+    """Runs a query in lcodb_dev with psql and returns the rows.
+
+    Queries are also run in dry-run mode, so they must not modify the
+    database.
+
+    """
+
+    output = subprocess.check_output(
+        ['psql', '-U', 'sdssdb_admin', '-d', 'lcodb_dev', '-tA',
+         '-F', ',', '-c', sql])
+
+    return [line.split(',') for line in output.decode().splitlines()
+            if line.strip() != '']
+
+
+def parseTOC(toc):
+    """Parses the output of ``pg_restore -l -v``.
+
+    Returns a list of ``(dumpId, line)`` tuples, where ``dumpId`` is ``None``
+    for comments, and a dictionary of the entries by dump id. Each entry is
+    a dictionary with the ``type``, ``schema`` and ``tag`` of the entry and
+    the set of dump ids it ``depends`` on.
+
+    """
+
+    lines = []
+    entries = {}
+    dumpId = None
+
+    for line in toc.splitlines():
+        match = toc_line_re.match(line)
+        if match:
+            dumpId = int(match.group('dumpId'))
+            entries[dumpId] = dict(_splitTOCEntry(match.group('entry')),
+                                   depends=set())
+            lines.append((dumpId, line))
+            continue
+        match = toc_depends_re.match(line)
+        if match and dumpId is not None:
+            entries[dumpId]['depends'].update(
+                int(depId) for depId in match.group('dumpIds').split())
+            lines.append((dumpId, line))
+            continue
+        lines.append((None, line))
+
+    return lines, entries
+
+
+def _splitTOCEntry(entry):
+    """Splits the description of a TOC entry into type, schema and tag.
+
+    The type can contain several words (e.g., ``FK CONSTRAINT``), and so can
+    the tag (e.g., ``table constraint`` in dumps from pg_dump 11+). The last
+    word is the owner, which is not returned.
+
+    """
+
+    words = entry.split()
+
+    # The schema is the first word that is not upper case or "-". Types are
+    # always upper case, while schema names (unless quoted) are not.
+    for ii in range(1, len(words)):
+        if words[ii] == '-' or not words[ii].isupper():
+            return {'type': ' '.join(words[:ii]), 'schema': words[ii],
+                    'tag': ' '.join(words[ii + 1:-1])}
+
+    return {'type': entry, 'schema': None, 'tag': ''}
+
+
+def filterTOC(toc, tables):
+    """Filters a pg_restore TOC list to only restore some tables.
+
+    ``toc`` is the output of ``pg_restore -l -v``. The tables not in
+    ``tables`` are removed, along with all the entries that depend on them,
+    directly or through other entries: their data, indexes, constraints,
+    triggers, defaults, comments and privileges, foreign keys from other
+    tables, and views that select from them. Sequences owned by a removed
+    table are also removed. Entries that do not belong to any table are
+    kept. Returns the lines of the filtered TOC list.
+
+    """
+
+    tables = set(tables)
+
+    lines, entries = parseTOC(toc)
+
+    removed = set(dumpId for dumpId, entry in entries.items()
+                  if entry['type'] in toc_table_types and
+                  entry['tag'] not in tables)
+
+    # Propagates the removal to the dependent entries until nothing changes.
+    nRemoved = None
+    while nRemoved != len(removed):
+        nRemoved = len(removed)
+        for dumpId, entry in entries.items():
+            if dumpId in removed:
+                for depId in entry['depends']:
+                    if (depId in entries and entries[depId]['type'] in
+                            toc_owned_types.get(entry['type'], [])):
+                        removed.add(depId)
+            elif entry['depends'] & removed:
+                removed.add(dumpId)
+
+    return [line for dumpId, line in lines if dumpId not in removed]
+
+
+def makeTOCList(path, tables):
+    """Creates a pg_restore TOC list that only restores some tables.
+
+    Runs ``pg_restore -l -v`` on the dump and filters it with `filterTOC`.
+    Returns the path to the TOC list file.
+
+    """
+
+    toc = subprocess.check_output(['pg_restore', '-l', '-v', path]).decode()
+
+    lines = filterTOC(toc, tables)
+
+    tocFile, tocPath = tempfile.mkstemp(suffix='.list', prefix='lcodb_dev_')
+    with os.fdopen(tocFile, 'w') as unit:
+        unit.write('\n'.join(lines) + '\n')
+
+    return tocPath
+
+
+def trimFootprint(footprint, schema='catalogdb', columns=('ra', 'dec')):
+    """Removes the rows outside a footprint from the tables of a schema.
+
+    ``footprint`` is ``(raMin, raMax, decMin, decMax)``. If ``raMin >
+    raMax``, the footprint wraps around RA=0. Only tables with both
+    ``columns`` are trimmed. The trimmed tables are then rewritten with
+    ``VACUUM FULL``, which rebuilds their indexes, and analysed. In dry-run
+    mode, the rows outside the footprint are only counted.
+
+    """
+
+    raMin, raMax, decMin, decMax = map(float, footprint)
+    raColumn, decColumn = columns
+
+    tables = querySQL(
+        'SELECT table_name FROM information_schema.columns '
+        'WHERE table_schema = \'{0}\' AND column_name IN (\'{1}\', \'{2}\') '
+        'GROUP BY table_name HAVING count(*) = 2'.format(schema, raColumn,
+                                                         decColumn))
+
+    raOperator = 'AND' if raMin <= raMax else 'OR'
+
+    for table, in tables:
+        with timed('Trimming {0}.{1}'.format(schema, table)) as metrics:
+            where = ('NOT (({0} >= {2!r} {1} {0} <= {3!r}) AND '
+                     '{4} BETWEEN {5!r} AND {6!r})'.format(
+                         raColumn, raOperator, raMin, raMax,
+                         decColumn, decMin, decMax))
+            if dry_run:
+                metrics['rows'] = int(querySQL(
+                    'SELECT count(*) FROM {0}.{1} WHERE {2}'.format(
+                        schema, table, where))[0][0])
+                print('Would remove {0} rows.'.format(metrics['rows']))
+            else:
+                status = runSQL('DELETE FROM {0}.{1} WHERE {2}'.format(
+                    schema, table, where))
+                metrics['rows'] = int(status.split()[-1])
+                print('Removed {0} rows.'.format(metrics['rows']))
+            runSQL('VACUUM FULL ANALYZE {0}.{1}'.format(schema, table))
 
-    # Now that the DB exists, imports the model classes
+
+def restoreSchemas(files, jobs=1, ignoreErrors=False, tables=None):
+    """Restores several dumps into lcodb_dev concurrently.
+
+    Each dump is restored by a different ``pg_restore`` process using
+    ``jobs`` parallel jobs. ``tables`` can be a dictionary of dump files to
+    lists of tables, in which case only those tables are restored from the
+    dump (see `makeTOCList`). Returns a dictionary with the wall-clock time
+    each restore took. The metrics of each restore, including the size of
+    the dump, are recorded as a separate phase.
+
+    """
+
+    tables = tables or {}
+    tocPaths = []
+
+    processes = {}
+    metrics = {}
+    times = {}
+    try:
+        # The restores are started inside the try, so that a failure while
+        # starting one does not leave the others running.
+        for file in files:
+            schema = file.split('_')[0]
+            print('Restoring {0} ... '.format(schema))
+            path = os.path.join(apodb_path, file)
+            command = ['pg_restore', '-d', 'lcodb_dev', '-Fc',
+                       '-U', 'sdssdb_admin', '-j', str(jobs), path]
+            metrics[schema] = {'phase': 'Restoring {0}'.format(schema),
+                               'bytes': os.path.getsize(path), 'jobs': jobs,
+                               'dry_run': dry_run}
+            if tables.get(file) is not None:
+                tocPaths.append(makeTOCList(path, tables[file]))
+                command += ['-L', tocPaths[-1]]
+                metrics[schema]['tables'] = list(tables[file])
+            if dry_run:
+                print('Would run: {0} ({1:d} bytes)'.format(
+                    ' '.join(command), metrics[schema]['bytes']))
+                continue
+            metrics[schema]['start'] = time.time()
+            processes[schema] = (command, subprocess.Popen(command))
+
+        while len(times) < len(processes):
+            for schema, (command, process) in processes.items():
+                if schema in times or process.poll() is None:
+                    continue
+                times[schema] = time.time() - metrics[schema]['start']
+                metrics[schema]['wall_time'] = times[schema]
+                metrics[schema]['returncode'] = process.returncode
+                recordMetrics(metrics[schema])
+                print('Restored {0} in {1:.1f} s.'.format(schema,
+                                                          times[schema]))
+                checkReturnCode(command, process.returncode,
+                                ignoreErrors=ignoreErrors)
+            if len(times) < len(processes):
+                time.sleep(0.1)
+    except BaseException:
+        # If one of the restores fails, we do not leave the others running.
+        for command, process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        raise
+    finally:
+        for tocPath in tocPaths:
+            os.remove(tocPath)
+
+    if dry_run:
+        for schema in metrics:
+            recordMetrics(metrics[schema])
+
+    return times
+
+
+def fixLCODevDB():
+    """Modifies the restored platedb for LCO.
+
+    Adds the LCO Cosmic location, flips the declination of the pointings of
+    all plates not at LCO, moves APO and Cosmic plates to LCO and LCO
+    Cosmic, and removes the cartridges with number > 5. Everything is done
+    with a few set-based statements in a single transaction.
+
+    In dry-run mode, nothing is modified. The rows each step would touch
+    are counted in the current lcodb_dev with the same filters.
+
+    """
+
+    # Now that the DB exists, imports the connection and model classes
+    from sdss.internal.database.connections import \
+        LCODatabaseDevAdminLocalConnection as db
     from sdss.internal.database.apo.platedb import ModelClasses as platedb
 
     session = db.Session()
 
-    # Adds location "LCO Cosmic"
-    print('Adding LCO Cosmic ...')
-    with session.begin():
-        newLocation = platedb.PlateLocation(label='LCO Cosmic')
-        session.add(newLocation)
+    lcoLabels = ['LCO', 'LCO Cosmic']
 
-    # Changes the sign of the declination of all plates that are not at LCO
-    print('Modifying declinations and location ...')
+    transaction = session.begin()
 
-    plates = session.query(platedb.Plate).join(platedb.PlateLocation).filter(
-        platedb.PlateLocation.label != 'LCO' and
-        platedb.PlateLocation.label != 'LCO Cosmic').all()
+    try:
 
-    lco_location_pk = session.query(platedb.PlateLocation).filter(
-        platedb.PlateLocation.label == 'LCO').first().pk
-    lco_cosmic_location_pk = session.query(platedb.PlateLocation).filter(
-        platedb.PlateLocation.label == 'LCO Cosmic').first().pk
+        # Adds location "LCO Cosmic"
+        with timed('Adding LCO Cosmic') as metrics:
+            if not dry_run:
+                session.add(platedb.PlateLocation(label='LCO Cosmic'))
+                session.flush()
+            metrics['rows'] = 1
 
-    with session.begin():
-        for plate in plates:
-            if len(plate.plate_pointings) == 0:
-                continue
-            for ii in range(len(plate.plate_pointings)):
-                plate.plate_pointings[ii].pointing.center_dec = (
-                    float(plate.plate_pointings[ii].pointing.center_dec) * -1.)
-
-            location = plate.location.label
-            if location == 'APO':
-                plate.plate_location_pk = lco_location_pk
-            elif location == 'Cosmic':
-                plate.plate_location_pk = lco_cosmic_location_pk
-
-    print('Removing extraneous cartridges ... ')
-    cartridges = session.query(platedb.Cartridge).all()
-    with session.begin():
-        for cart in cartridges:
-            if cart.number <= 5:
-                pass
-                # cart.number += 20
+        locationPks = dict(
+            session.query(platedb.PlateLocation.label,
+                          platedb.PlateLocation.pk).filter(
+                platedb.PlateLocation.label.in_(
+                    ['APO', 'Cosmic'] + lcoLabels)).all())
+
+        # Changes the sign of the declination of all plates that are not at
+        # LCO. This must happen before the plates are moved to LCO.
+        with timed('Modifying declinations') as metrics:
+            nonLCOPointings = session.query(
+                platedb.PlatePointing.pointing_pk).join(
+                    platedb.Plate).join(platedb.PlateLocation).filter(
+                        ~platedb.PlateLocation.label.in_(lcoLabels))
+            pointings = session.query(platedb.Pointing).filter(
+                platedb.Pointing.pk.in_(nonLCOPointings.subquery()))
+            if dry_run:
+                nPointings = pointings.count()
             else:
-                session.delete(cart)
+                nPointings = pointings.update(
+                    {platedb.Pointing.center_dec:
+                        -platedb.Pointing.center_dec},
+                    synchronize_session=False)
+            print('{0} the declination of {1} pointings.'.format(
+                'Would flip' if dry_run else 'Flipped', nPointings))
+            metrics['rows'] = nPointings
+
+        # Moves the plates with pointings from APO to LCO and from Cosmic to
+        # LCO Cosmic.
+        with timed('Modifying locations') as metrics:
+            platesWithPointings = session.query(
+                platedb.PlatePointing.plate_pk).subquery()
+            metrics['rows'] = 0
+            for oldLabel, newLabel in [('APO', 'LCO'),
+                                       ('Cosmic', 'LCO Cosmic')]:
+                if oldLabel not in locationPks:
+                    continue
+                plates = session.query(platedb.Plate).filter(
+                    platedb.Plate.plate_location_pk == locationPks[oldLabel],
+                    platedb.Plate.pk.in_(platesWithPointings))
+                if dry_run:
+                    nPlates = plates.count()
+                else:
+                    nPlates = plates.update(
+                        {platedb.Plate.plate_location_pk:
+                            locationPks[newLabel]},
+                        synchronize_session=False)
+                print('{0} {1} plates from {2} to {3}.'.format(
+                    'Would move' if dry_run else 'Moved', nPlates, oldLabel,
+                    newLabel))
+                metrics['rows'] += nPlates
+
+        with timed('Removing extraneous cartridges') as metrics:
+            cartridges = session.query(platedb.Cartridge).filter(
+                platedb.Cartridge.number > 5)
+            if dry_run:
+                nCartridges = cartridges.count()
+            else:
+                nCartridges = cartridges.delete(synchronize_session=False)
+            print('{0} {1} cartridges.'.format(
+                'Would remove' if dry_run else 'Removed', nCartridges))
+            metrics['rows'] = nCartridges
+
+    except BaseException:
+        transaction.rollback()
+        raise
+    else:
+        if dry_run:
+            transaction.rollback()
+        else:
+            transaction.commit()
+
+    # Closes all the connections to lcodb_dev so that it can be used as the
+    # source of createdb -T.
+    engine = session.get_bind()
+    session.close()
+    engine.dispose()
+
+
+def isFreshlyRestored():
+    """Checks if lcodb_dev contains the data as restored from the dumps.
+
+    That is, if lcodb_dev exists and has not been modified by
+    `fixLCODevDB`, which adds the LCO Cosmic location.
+
+    """
+
+    try:
+        rows = querySQL('SELECT count(*) FROM platedb.plate_location '
+                        'WHERE label = \'LCO Cosmic\'')
+    except (subprocess.CalledProcessError, OSError):
+        return False
+
+    return int(rows[0][0]) == 0
+
+
+def getDumpsFingerprint(files, checksum=False):
+    """Returns a fingerprint of the dump files.
+
+    The fingerprint includes the size and mtime of each file and, if
+    ``checksum=True``, its MD5 checksum.
+
+    """
+
+    fingerprint = {}
+
+    for file in files:
+        path = os.path.join(apodb_path, file)
+        stat = os.stat(path)
+        fingerprint[file] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if checksum:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as unit:
+                for chunk in iter(lambda: unit.read(2**20), b''):
+                    md5.update(chunk)
+            fingerprint[file]['md5'] = md5.hexdigest()
+
+    return fingerprint
+
+
+def databaseExists(name):
+    """Returns ``True`` if a database exists."""
+
+    output = subprocess.check_output(
+        ['psql', '-U', 'postgres', '-d', 'postgres', '-tAc',
+         'SELECT 1 FROM pg_database WHERE datname = \'{0}\''.format(name)])
+
+    return output.strip() == b'1'
+
+
+def templateIsCurrent(fingerprint):
+    """Checks if the template database was built from the current dumps."""
+
+    if not os.path.exists(template_state_file):
+        return False
+
+    with open(template_state_file, 'r') as unit:
+        state = json.load(unit)
+
+    return state == fingerprint and databaseExists(template_db)
+
+
+def buildLCODevDB(jobs=1, ignoreErrors=False, catalogTables=None,
+                  footprint=None):
+    """Builds lcodb_dev from scratch from the dumps.
+
+    If ``catalogTables`` is set, only those tables are restored from the
+    catalogdb dump. If ``footprint`` is set, the catalogdb rows outside it
+    are removed after the restore (see `trimFootprint`).
+
+    """
+
+    # First we drop lcodb_dev
+    with timed('Dropping lcodb_dev'):
+        runCommand(['dropdb', '--if-exists', '-U', 'postgres', 'lcodb_dev'])
+
+    # Recreates the DB
+    with timed('Creating lcodb_dev'):
+        runCommand(['createdb', '-T', 'template0', '-U', 'postgres',
+                    'lcodb_dev'])
+
+    # Restores platedb and catalogdb
+    restoreSchemas([platedb_file, catalogdb_file], jobs=jobs,
+                   ignoreErrors=ignoreErrors,
+                   tables={catalogdb_file: catalogTables})
+
+    if not dry_run:
+        if footprint is not None:
+            trimFootprint(footprint)
+        fixLCODevDB()
+        return
+
+    # In dry-run mode, the rows that the post-restore steps would touch
+    # are counted in the current lcodb_dev, but only if it still contains
+    # the data as restored from the dumps.
+    if isFreshlyRestored():
+        if footprint is not None:
+            trimFootprint(footprint)
+        fixLCODevDB()
+    else:
+        with timed('Modifying lcodb_dev') as metrics:
+            print('The current lcodb_dev is not freshly restored. The rows '
+                  'modified after the restore are unknown.')
+            metrics['rows'] = None
+
+
+def restoreLCODevDB(jobs=1, ignoreErrors=False, snapshot=False,
+                    rebuild=False, checksum=False, catalogTables=None,
+                    footprint=None):
+    """Restores lcodb_dev from a file and modifies it.
+
+    platedb and catalogdb are restored concurrently, each of them with
+    ``jobs`` parallel jobs. If ``ignoreErrors=True``, a non-zero exit status
+    from ``pg_restore`` (for example, because of missing roles) is reported
+    but does not stop the process.
+
+    If ``snapshot=True``, a copy of the restored and modified lcodb_dev is
+    kept as the template database ``template_db``. Later resets clone the
+    template with ``createdb -T``, which takes seconds. The template is
+    rebuilt when the dumps change (according to their size and mtime and,
+    if ``checksum=True``, their MD5 checksum), or if ``rebuild=True``.
+
+    ``catalogTables`` and ``footprint`` define a lightweight profile in which
+    only some catalogdb tables, and only their rows in a sky footprint, are
+    restored (see `buildLCODevDB`).
+
+    The wall-clock time and metrics of each phase are written to
+    ``metrics_file``, if set. If ``dry_run`` is set, no changes are made and
+    each phase reports what it would do.
+
+    """
+
+    with timed('Resetting lcodb_dev', snapshot=snapshot):
+        if snapshot:
+            _restoreSnapshot(jobs=jobs, ignoreErrors=ignoreErrors,
+                             rebuild=rebuild, checksum=checksum,
+                             catalogTables=catalogTables, footprint=footprint)
+        else:
+            buildLCODevDB(jobs=jobs, ignoreErrors=ignoreErrors,
+                          catalogTables=catalogTables, footprint=footprint)
 
     return
 
 
+def _restoreSnapshot(jobs=1, ignoreErrors=False, rebuild=False,
+                     checksum=False, catalogTables=None, footprint=None):
+    """Resets lcodb_dev from the template database, rebuilding it if needed.
+
+    See `restoreLCODevDB`.
+
+    """
+
+    fingerprint = getDumpsFingerprint([platedb_file, catalogdb_file],
+                                      checksum=checksum)
+
+    # The template must also be rebuilt if the restore profile changes.
+    fingerprint['profile'] = {
+        'catalogTables': sorted(catalogTables) if catalogTables else None,
+        'footprint': list(map(float, footprint)) if footprint else None}
+
+    if rebuild or not templateIsCurrent(fingerprint):
+
+        buildLCODevDB(jobs=jobs, ignoreErrors=ignoreErrors,
+                      catalogTables=catalogTables, footprint=footprint)
+
+        with timed('Creating template {0}'.format(template_db)):
+            if os.path.exists(template_state_file) and not dry_run:
+                os.remove(template_state_file)
+            runCommand(['dropdb', '--if-exists', '-U', 'postgres',
+                        template_db])
+            runCommand(['createdb', '-T', 'lcodb_dev', '-U', 'postgres',
+                        template_db])
+            if not dry_run:
+                with open(template_state_file, 'w') as unit:
+                    json.dump(fingerprint, unit)
+
+    else:
+
+        with timed('Dropping lcodb_dev'):
+            runCommand(['dropdb', '--if-exists', '-U', 'postgres',
+                        'lcodb_dev'])
+
+        with timed('Cloning {0} into lcodb_dev'.format(template_db)):
+            runCommand(['createdb', '-T', template_db, '-U', 'postgres',
+                        'lcodb_dev'])
+
+
 if __name__ == '__main__':
-    restoreLCODevDB()
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]))
+
+    parser.add_argument('--jobs', '-j', metavar='jobs', type=int, default=1,
+                        help='The number of parallel jobs for each '
+                             'pg_restore.')
+    parser.add_argument('--ignore-restore-errors', dest='ignoreErrors',
+                        action='store_true', default=False,
+                        help='Do not stop if pg_restore returns a '
+                             'non-zero exit status.')
+    parser.add_argument('--snapshot', '-s', action='store_true',
+                        default=False,
+                        help='Clone lcodb_dev from a template database, '
+                             'which is only rebuilt if the dumps change.')
+    parser.add_argument('--rebuild', action='store_true', default=False,
+                        help='In snapshot mode, rebuild the template even if '
+                             'the dumps have not changed.')
+    parser.add_argument('--checksum', action='store_true', default=False,
+                        help='In snapshot mode, also compare the MD5 '
+                             'checksum of the dumps.')
+    parser.add_argument('--tables', '-t', metavar='tables', type=str,
+                        default=None,
+                        help='A comma-separated list of catalogdb tables to '
+                             'restore. By default, all tables are restored.')
+    parser.add_argument('--footprint', '-f', type=float, nargs=4,
+                        metavar=('RAMIN', 'RAMAX', 'DECMIN', 'DECMAX'),
+                        default=None,
+                        help='Only keep the catalogdb rows in this '
+                             'footprint.')
+    parser.add_argument('--metrics', '-m', metavar='metrics', type=str,
+                        default=None,
+                        help='A file to which the metrics of each phase are '
+                             'appended as JSON lines.')
+    parser.add_argument('--dry-run', '-n', dest='dryRun',
+                        action='store_true', default=False,
+                        help='Report what each phase would do without '
+                             'modifying anything.')
+
+    args = parser.parse_args()
+
+    metrics_file = args.metrics
+    dry_run = args.dryRun
+
+    restoreLCODevDB(jobs=args.jobs, ignoreErrors=args.ignoreErrors,
+                    snapshot=args.snapshot, rebuild=args.rebuild,
+                    checksum=args.checksum,
+                    catalogTables=(args.tables.split(',') if args.tables
+                                   else None),
+                    footprint=args.footprint)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# test_restoreLCODevDB.py
+#
+# Licensed under a 3-clause BSD license.
+
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import restoreLCODevDB  # noqa
+
+
+# The output of pg_restore -l -v for a catalogdb with the tables photoobj and
+# tycho2, as written by pg_dump 9.6. The tags of constraints and triggers
+# only contain their name.
+toc_pg96 = """;
+; Archive created at 2016-07-12 10:00:00 UTC
+;     dbname: apodb
+;     Dumped from database version: 9.6.3
+;     Dumped by pg_dump version: 9.6.3
+;
+; Selected TOC Entries:
+;
+8; 2615 16385 SCHEMA - catalogdb sdssdb_admin
+200; 1259 16390 TABLE catalogdb photoobj sdssdb_admin
+;\tdepends on: 8
+201; 1259 16388 SEQUENCE catalogdb photoobj_pk_seq sdssdb_admin
+;\tdepends on: 8
+202; 0 0 SEQUENCE OWNED BY catalogdb photoobj_pk_seq sdssdb_admin
+;\tdepends on: 201 200
+203; 1259 16400 TABLE catalogdb tycho2 sdssdb_admin
+;\tdepends on: 8
+204; 1259 16398 SEQUENCE catalogdb tycho2_pk_seq sdssdb_admin
+;\tdepends on: 8
+205; 0 0 SEQUENCE OWNED BY catalogdb tycho2_pk_seq sdssdb_admin
+;\tdepends on: 204 203
+206; 1259 16410 VIEW catalogdb bright_stars sdssdb_admin
+;\tdepends on: 203 8
+207; 1259 16414 VIEW catalogdb bright_photoobj sdssdb_admin
+;\tdepends on: 200 8
+208; 1259 16418 MATERIALIZED VIEW catalogdb tycho2_photoobj sdssdb_admin
+;\tdepends on: 200 203 8
+209; 2604 16392 DEFAULT catalogdb photoobj pk sdssdb_admin
+;\tdepends on: 201 200
+210; 2604 16402 DEFAULT catalogdb tycho2 pk sdssdb_admin
+;\tdepends on: 204 203
+2100; 0 16390 TABLE DATA catalogdb photoobj sdssdb_admin
+;\tdepends on: 200
+2101; 0 16400 TABLE DATA catalogdb tycho2 sdssdb_admin
+;\tdepends on: 203
+2102; 0 0 SEQUENCE SET catalogdb photoobj_pk_seq sdssdb_admin
+;\tdepends on: 201
+2103; 0 0 SEQUENCE SET catalogdb tycho2_pk_seq sdssdb_admin
+;\tdepends on: 204
+2104; 2606 16420 CONSTRAINT catalogdb pk_photoobj sdssdb_admin
+;\tdepends on: 200 200
+2105; 2606 16422 CONSTRAINT catalogdb tycho2_pkey sdssdb_admin
+;\tdepends on: 203 203
+2106; 1259 16424 INDEX catalogdb photoobj_radec_idx sdssdb_admin
+;\tdepends on: 200
+2107; 1259 16425 INDEX catalogdb idx_tycho2_radec sdssdb_admin
+;\tdepends on: 203
+2108; 1259 16426 INDEX catalogdb tycho2_photoobj_idx sdssdb_admin
+;\tdepends on: 208
+2109; 2620 16428 TRIGGER catalogdb check_radec sdssdb_admin
+;\tdepends on: 200
+2110; 2606 16430 FK CONSTRAINT catalogdb photoobj_tycho2_fk sdssdb_admin
+;\tdepends on: 200 2105
+2111; 0 16418 MATERIALIZED VIEW DATA catalogdb tycho2_photoobj sdssdb_admin
+;\tdepends on: 208 2100 2101
+2112; 0 0 COMMENT catalogdb TABLE tycho2 sdssdb_admin
+;\tdepends on: 203
+2113; 0 0 ACL catalogdb TABLE photoobj sdssdb_admin
+;\tdepends on: 200
+"""
+
+# The same dump, as written by pg_dump 11. The tags of constraints and
+# triggers start with the name of their table, and the comments and
+# privileges on the schema are listed.
+toc_pg11 = """;
+; Archive created at 2019-01-10 10:00:00 UTC
+;     dbname: apodb
+;     Dumped from database version: 11.1
+;     Dumped by pg_dump version: 11.1
+;
+; Selected TOC Entries:
+;
+8; 2615 16385 SCHEMA - catalogdb sdssdb_admin
+2114; 0 0 COMMENT - SCHEMA catalogdb sdssdb_admin
+;\tdepends on: 8
+200; 1259 16390 TABLE catalogdb photoobj sdssdb_admin
+;\tdepends on: 8
+201; 1259 16388 SEQUENCE catalogdb photoobj_pk_seq sdssdb_admin
+;\tdepends on: 8
+202; 0 0 SEQUENCE OWNED BY catalogdb photoobj_pk_seq sdssdb_admin
+;\tdepends on: 201 200
+203; 1259 16400 TABLE catalogdb tycho2 sdssdb_admin
+;\tdepends on: 8
+204; 1259 16398 SEQUENCE catalogdb tycho2_pk_seq sdssdb_admin
+;\tdepends on: 8
+205; 0 0 SEQUENCE OWNED BY catalogdb tycho2_pk_seq sdssdb_admin
+;\tdepends on: 204 203
+206; 1259 16410 VIEW catalogdb bright_stars sdssdb_admin
+;\tdepends on: 203 8
+207; 1259 16414 VIEW catalogdb bright_photoobj sdssdb_admin
+;\tdepends on: 200 8
+208; 1259 16418 MATERIALIZED VIEW catalogdb tycho2_photoobj sdssdb_admin
+;\tdepends on: 200 203 8
+209; 2604 16392 DEFAULT catalogdb photoobj pk sdssdb_admin
+;\tdepends on: 201 200
+210; 2604 16402 DEFAULT catalogdb tycho2 pk sdssdb_admin
+;\tdepends on: 204 203
+2100; 0 16390 TABLE DATA catalogdb photoobj sdssdb_admin
+;\tdepends on: 200
+2101; 0 16400 TABLE DATA catalogdb tycho2 sdssdb_admin
+;\tdepends on: 203
+2102; 0 0 SEQUENCE SET catalogdb photoobj_pk_seq sdssdb_admin
+;\tdepends on: 201
+2103; 0 0 SEQUENCE SET catalogdb tycho2_pk_seq sdssdb_admin
+;\tdepends on: 204
+2104; 2606 16420 CONSTRAINT catalogdb photoobj pk_photoobj sdssdb_admin
+;\tdepends on: 200 200
+2105; 2606 16422 CONSTRAINT catalogdb tycho2 tycho2_pkey sdssdb_admin
+;\tdepends on: 203 203
+2106; 1259 16424 INDEX catalogdb photoobj_radec_idx sdssdb_admin
+;\tdepends on: 200
+2107; 1259 16425 INDEX catalogdb idx_tycho2_radec sdssdb_admin
+;\tdepends on: 203
+2108; 1259 16426 INDEX catalogdb tycho2_photoobj_idx sdssdb_admin
+;\tdepends on: 208
+2109; 2620 16428 TRIGGER catalogdb photoobj check_radec sdssdb_admin
+;\tdepends on: 200
+2110; 2606 16430 FK CONSTRAINT catalogdb photoobj photoobj_tycho2_fk sdssdb_admin
+;\tdepends on: 200 2105
+2111; 0 16418 MATERIALIZED VIEW DATA catalogdb tycho2_photoobj sdssdb_admin
+;\tdepends on: 208 2100 2101
+2112; 0 0 COMMENT catalogdb TABLE tycho2 sdssdb_admin
+;\tdepends on: 203
+2113; 0 0 ACL catalogdb TABLE photoobj sdssdb_admin
+;\tdepends on: 200
+"""
+
+
+def getEntries(lines):
+    """Returns the TOC entries in a list of lines, without their dump id."""
+
+    return set(line.split(' ', 3)[3] for line in lines
+               if restoreLCODevDB.toc_line_re.match(line))
+
+
+@pytest.fixture(params=['pg96', 'pg11'])
+def toc(request):
+    return toc_pg96 if request.param == 'pg96' else toc_pg11
+
+
+def test_splitTOCEntry():
+
+    assert restoreLCODevDB._splitTOCEntry(
+        'FK CONSTRAINT catalogdb photoobj photoobj_tycho2_fk sdssdb_admin') == \
+        {'type': 'FK CONSTRAINT', 'schema': 'catalogdb',
+         'tag': 'photoobj photoobj_tycho2_fk'}
+    assert restoreLCODevDB._splitTOCEntry(
+        'CONSTRAINT catalogdb tycho2_pkey sdssdb_admin') == \
+        {'type': 'CONSTRAINT', 'schema': 'catalogdb', 'tag': 'tycho2_pkey'}
+    assert restoreLCODevDB._splitTOCEntry(
+        'SCHEMA - catalogdb sdssdb_admin') == \
+        {'type': 'SCHEMA', 'schema': '-', 'tag': 'catalogdb'}
+
+
+def test_parseTOC(toc):
+
+    lines, entries = restoreLCODevDB.parseTOC(toc)
+
+    assert [line for dumpId, line in lines] == toc.splitlines()
+    assert entries[2110]['type'] == 'FK CONSTRAINT'
+    assert entries[2110]['depends'] == set([200, 2105])
+    assert entries[8]['depends'] == set()
+
+
+def test_filterTOC_all(toc):
+
+    lines = restoreLCODevDB.filterTOC(toc, ['photoobj', 'tycho2'])
+
+    assert lines == toc.splitlines()
+
+
+def test_filterTOC(toc):
+
+    lines = restoreLCODevDB.filterTOC(toc, ['photoobj'])
+    entries = getEntries(lines)
+
+    kept = set(entry for entry in getEntries(toc.splitlines())
+               if 'tycho2' not in entry and 'bright_stars' not in entry)
+
+    # The constraints and triggers of photoobj are kept in both tag formats,
+    # even if their names do not start with the name of the table.
+    assert entries == kept
+    assert any(entry.startswith('CONSTRAINT') for entry in entries)
+    assert any(entry.startswith('TRIGGER') for entry in entries)
+
+    # The comments and dependency lines of the kept entries are kept.
+    expected = []
+    keep = True
+    for line in toc.splitlines():
+        if restoreLCODevDB.toc_line_re.match(line):
+            keep = line.split(' ', 3)[3] in kept
+        elif not line.startswith(';\tdepends on:'):
+            keep = True
+        if keep:
+            expected.append(line)
+
+    assert lines == expected
+
+
+def test_filterTOC_views(toc):
+
+    entries = getEntries(restoreLCODevDB.filterTOC(toc, ['tycho2']))
+
+    # Views and materialized views are kept only if all their tables are.
+    assert 'VIEW catalogdb bright_stars sdssdb_admin' in entries
+    assert 'VIEW catalogdb bright_photoobj sdssdb_admin' not in entries
+    assert not any('tycho2_photoobj' in entry for entry in entries)
+
+    # Foreign keys to a kept table from a removed one are removed.
+    assert not any('photoobj_tycho2_fk' in entry for entry in entries)
+
+    # The sequence owned by the removed table is removed, even if its name
+    # does not start with the name of a kept table.
+    assert not any('photoobj_pk_seq' in entry for entry in entries)
+    assert 'SEQUENCE catalogdb tycho2_pk_seq sdssdb_admin' in entries
+    assert 'INDEX catalogdb idx_tycho2_radec sdssdb_admin' in entries
+
+
+def test_filterTOC_rule():
+
+    toc = '\n'.join([
+        '200; 1259 16390 TABLE catalogdb photoobj sdssdb_admin',
+        '206; 1259 16410 VIEW catalogdb photoobj_view sdssdb_admin',
+        '2120; 2618 16412 RULE catalogdb photoobj_view _RETURN sdssdb_admin',
+        ';\tdepends on: 206 200'])
+
+    assert restoreLCODevDB.filterTOC(toc, []) == []
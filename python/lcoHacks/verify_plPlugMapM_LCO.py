@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# verify_plPlugMapM_LCO.py
+#
+# Licensed under a 3-clause BSD license.
+
+
+from __future__ import division
+from __future__ import print_function
+import sys
+import os
+import numpy as np
+import argparse
+import re
+import time
+
+from create_plPlugMapM_LCO import (colourDict, nGuides, PlateIndex,
+                                   readPar, readPlPlugMapP, selectHoles)
+
+
+plPlugMapMRe = re.compile(
+    r'^plPlugMapM-(\d+)([B-Z]?)-(\d+)-(\d+)_([A-Z]+)\.par$')
+
+# Links marking colours to field numbers
+fieldDict = dict((colour, field) for field, colour in colourDict.items())
+
+
+def _positions(holes):
+    """Returns the focal plane positions of the holes as complex numbers."""
+
+    return holes['xFocal'] + 1j * holes['yFocal']
+
+
+def _sameHoles(holesM, holesP):
+    """Checks that two sets of holes are in the same positions."""
+
+    return bool(np.array_equal(np.sort(_positions(holesM)),
+                               np.sort(_positions(holesP))))
+
+
+def _getGuidenums(header, pointing):
+    """Returns the guidenums for a pointing in a header, or ``None``."""
+
+    pointingNum = 0 if pointing == 'A' else ord(pointing) - ord('A')
+    keyword = 'guidenums' + str(pointingNum + 1)
+
+    for line in header:
+        values = line.split()
+        if len(values) > 0 and values[0] == keyword:
+            return [int(value) for value in values[1:]]
+
+    return None
+
+
+def diffPlPlugMapM(plPlugMapM, headerM, plPlugMapObj, pointing, field):
+    """Compares a plPlugMapM with the plPlugMapP it was created from.
+
+    Returns a list of the problems found. An empty list means that the
+    plPlugMapM is consistent with the plPlugMapP.
+
+    """
+
+    problems = []
+
+    lightTrapsP, alignmentsP, guidesP = selectHoles(plPlugMapObj,
+                                                    pointing, field)
+
+    holeType = plPlugMapM['holeType']
+    lightTrapsM = plPlugMapM[holeType == 'LIGHT_TRAP']
+    alignmentsM = plPlugMapM[holeType == 'ALIGNMENT']
+    guidesM = plPlugMapM[holeType == 'GUIDE']
+
+    if not _sameHoles(lightTrapsM, lightTrapsP):
+        problems.append('light traps do not match the plPlugMapP')
+
+    if not _sameHoles(alignmentsM, alignmentsP):
+        problems.append('alignment holes do not match the plPlugMapP')
+
+    if not _sameHoles(guidesM, guidesP):
+        problems.append('guide positions do not match the plPlugMapP')
+    else:
+        # Checks that the guides kept the rest of their columns by sorting
+        # both sets by position.
+        sortM = np.argsort(_positions(guidesM))
+        sortP = np.argsort(_positions(guidesP))
+        for column in ['ra', 'dec', 'objId']:
+            if not np.array_equal(guidesM[column][sortM],
+                                  guidesP[column][sortP]):
+                problems.append('guide column {0} does not match the '
+                                'plPlugMapP'.format(column))
+
+    fiberIds = np.sort(guidesM['fiberId'])
+    if not np.array_equal(fiberIds, np.arange(1, nGuides + 1)):
+        missing = np.setdiff1d(np.arange(1, nGuides + 1), fiberIds)
+        problems.append('fiberIds are not a permutation of 1..{0} '
+                        '(missing: {1})'.format(nGuides, missing.tolist()))
+
+    guidenums = _getGuidenums(headerM, pointing)
+    if guidenums is None:
+        problems.append('guidenums not found in the header')
+    elif guidenums != list(range(1, nGuides + 1)):
+        problems.append('guidenums in the header are {0}'.format(guidenums))
+
+    if len(guidesP) != nGuides:
+        problems.append('the plPlugMapP has {0} guides for the field, '
+                        'not {1}'.format(len(guidesP), nGuides))
+
+    return problems
+
+
+def verifyPlPlugMapMs(paths, cacheDir=None, plateIndex=None):
+    """Verifies a list of plPlugMapM files or directories of plPlugMapMs.
+
+    Each plPlugMapP is read only once for all its plPlugMapMs. Returns a
+    dictionary with the list of problems for each plPlugMapM.
+
+    """
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, name)
+                      for name in sorted(os.listdir(path))
+                      if plPlugMapMRe.match(name)]
+        else:
+            files.append(path)
+
+    if plateIndex is not None:
+        plateIDs = set()
+        for filename in files:
+            match = plPlugMapMRe.match(os.path.basename(filename))
+            if match:
+                plateIDs.add(int(match.group(1)))
+        plateIndex = PlateIndex(plateIndex).refresh(plateIDs=plateIDs)
+        plateIndex.save()
+
+    plPlugMapPs = {}
+    results = {}
+
+    for filename in files:
+
+        match = plPlugMapMRe.match(os.path.basename(filename))
+        if not match or match.group(5) not in fieldDict:
+            results[filename] = ['cannot parse the file name']
+            continue
+
+        plateID = int(match.group(1))
+        pointing = match.group(2) or 'A'
+        field = fieldDict[match.group(5)]
+
+        if (plateID, pointing) not in plPlugMapPs:
+            try:
+                plPlugMapPs[(plateID, pointing)] = readPlPlugMapP(
+                    plateID, pointing, cacheDir=cacheDir,
+                    plateIndex=plateIndex)[0]
+            except IOError as ee:
+                plPlugMapPs[(plateID, pointing)] = ee
+
+        plPlugMapObj = plPlugMapPs[(plateID, pointing)]
+        if isinstance(plPlugMapObj, IOError):
+            results[filename] = [str(plPlugMapObj)]
+            continue
+
+        plPlugMapM, __, headerM = readPar(filename)
+
+        results[filename] = diffPlPlugMapM(plPlugMapM, headerM, plPlugMapObj,
+                                           pointing, field)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]))
+
+    parser.add_argument('PATHS', type=str, nargs='+',
+                        help='plPlugMapM files or directories to verify.')
+    parser.add_argument('--cacheDir', '-c', metavar='cacheDir',
+                        type=str, default=None,
+                        help='A directory in which to cache the parsed '
+                             'plPlugMapP files.')
+    parser.add_argument('--plateIndex', '-i', metavar='plateIndex',
+                        type=str, default=None,
+                        help='A file in which to keep an index of the '
+                             'plPlugMap files under PLATELIST_DIR.')
+
+    args = parser.parse_args()
+
+    start = time.time()
+    results = verifyPlPlugMapMs(args.PATHS, cacheDir=args.cacheDir,
+                                plateIndex=args.plateIndex)
+
+    nFailed = 0
+    for filename in sorted(results):
+        if len(results[filename]) == 0:
+            print('{0}: OK'.format(filename))
+            continue
+        nFailed += 1
+        for problem in results[filename]:
+            print('{0}: {1}'.format(filename, problem))
+
+    print('Verified {0} files in {1:.2f} s; {2} failed.'.format(
+        len(results), time.time() - start, nFailed))
+
+    sys.exit(1 if nFailed > 0 else 0)